@@ -0,0 +1,287 @@
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import store
+from database import LOGIN_DB, login_db
+
+HASH_ITERATIONS = 260000
+HASH_WORKERS = 2
+HASH_QUEUE_LIMIT = 32
+SESSION_TTL = 30 * 24 * 3600
+TOKEN_CACHE_SIZE = 10000
+# Bounds how long another process (the gateway) can keep honouring a token
+# revoked elsewhere; revocations in this process drop the entry immediately.
+TOKEN_CACHE_TTL = 300.0
+REHASH_CHUNK = 100
+REHASH_PAUSE = 0.05
+
+# Tokens are '<session id>.<HMAC of the id>'. The signature is checked before any
+# lookup, so forged tokens never reach the database. The key lives in login.db so
+# every process sharing it accepts the same tokens; DUCKCHAT_SECRET_KEY overrides it.
+MIGRATION = [
+    '''CREATE TABLE IF NOT EXISTS sessions (
+           id TEXT PRIMARY KEY,
+           user_id INTEGER NOT NULL,
+           login TEXT NOT NULL,
+           created_at TEXT NOT NULL,
+           expires_at REAL NOT NULL
+       ) WITHOUT ROWID''',
+    'CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)',
+    'CREATE TABLE IF NOT EXISTS auth_secret (key BLOB NOT NULL)',
+    'INSERT INTO auth_secret (key) SELECT randomblob(32) WHERE NOT EXISTS (SELECT 1 FROM auth_secret)',
+]
+
+
+class HashingBusy(Exception):
+    pass
+
+
+class TokenCache:
+    # LRU of session id -> user, each entry valid until its own deadline.
+    def __init__(self, size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    del self._entries[session_id]
+                self._misses += 1
+                return None
+            self._entries.move_to_end(session_id)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, session_id, user, expires_at):
+        with self._lock:
+            self._entries[session_id] = (user, min(expires_at, time.time() + self.ttl))
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'size': len(self._entries),
+                'capacity': self.size,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else 0.0,
+                'evictions': self._evictions,
+            }
+
+
+token_cache = TokenCache()
+
+# PBKDF2 holds a core for a noticeable time per call. A small pool keeps a login
+# burst to HASH_WORKERS cores, and callers beyond HASH_QUEUE_LIMIT are turned
+# away instead of piling up behind it.
+_hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix='password-hash')
+_hash_slots = threading.BoundedSemaphore(HASH_QUEUE_LIMIT)
+_secret = None
+_dummy = None
+
+
+def _run_hashing(fn, *args):
+    if not _hash_slots.acquire(blocking=False):
+        raise HashingBusy('Too many logins in progress')
+    try:
+        return _hash_pool.submit(fn, *args).result()
+    finally:
+        _hash_slots.release()
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+
+
+def _hash(password):
+    salt = os.urandom(16)
+    return f'pbkdf2_sha256${HASH_ITERATIONS}${_b64(salt)}${_b64(_pbkdf2(password, salt, HASH_ITERATIONS))}'
+
+
+def _verify(stored, password):
+    # Returns (matches, needs_rehash). Rows from before hashing hold the plain password.
+    if not stored.startswith('pbkdf2_sha256$'):
+        return hmac.compare_digest(stored.encode('utf-8'), password.encode('utf-8')), True
+    _, iterations, salt, expected = stored.split('$')
+    salt = base64.urlsafe_b64decode(salt + '=' * (-len(salt) % 4))
+    matches = hmac.compare_digest(_b64(_pbkdf2(password, salt, int(iterations))), expected)
+    return matches, int(iterations) != HASH_ITERATIONS
+
+
+def hash_password(password):
+    return _run_hashing(_hash, password)
+
+
+def _dummy_hash():
+    # Verified against when the login does not exist, so both cases cost the same.
+    global _dummy
+    if _dummy is None:
+        _dummy = _hash(secrets.token_hex(8))
+    return _dummy
+
+
+def authenticate(login, password):
+    with login_db() as conn:
+        user = store.user_by_login(conn, login)
+    matches, needs_rehash = _run_hashing(_verify, user['password'] if user else _dummy_hash(), password)
+    if not user or not matches:
+        return None
+    if needs_rehash:
+        new_hash = hash_password(password)
+        with login_db() as conn:
+            conn.execute('UPDATE personal_date SET password = ? WHERE id = ? AND password = ?',
+                         (new_hash, user['id'], user['password']))
+    return {'id': user['id'], 'login': user['login']}
+
+
+def _secret_key():
+    global _secret
+    if _secret is None:
+        key = os.environ.get('DUCKCHAT_SECRET_KEY')
+        if key:
+            _secret = key.encode('utf-8')
+        else:
+            with login_db() as conn:
+                _secret = conn.execute('SELECT key FROM auth_secret').fetchone()['key']
+    return _secret
+
+
+def _sign(session_id):
+    return _b64(hmac.new(_secret_key(), session_id.encode('ascii'), hashlib.sha256).digest())
+
+
+def _session_id(token):
+    session_id, _, signature = (token or '').partition('.')
+    if not session_id or not signature:
+        return None
+    try:
+        expected = _sign(session_id)
+    except UnicodeEncodeError:
+        return None
+    return session_id if hmac.compare_digest(expected, signature) else None
+
+
+def issue(user):
+    session_id = secrets.token_urlsafe(18)
+    now = time.time()
+    expires_at = now + SESSION_TTL
+    with login_db() as conn:
+        conn.execute('DELETE FROM sessions WHERE expires_at <= ?', (now,))
+        conn.execute('INSERT INTO sessions (id, user_id, login, created_at, expires_at) VALUES (?, ?, ?, ?, ?)',
+                     (session_id, user['id'], user['login'],
+                      datetime.now().strftime("%d/%m/%Y %H:%M:%S"), expires_at))
+    token_cache.put(session_id, {'user_id': user['id'], 'login': user['login']}, expires_at)
+    return f'{session_id}.{_sign(session_id)}', expires_at
+
+
+def resolve(token):
+    # {'user_id', 'login'} for a live session, else None. A cache hit costs no SQL.
+    session_id = _session_id(token)
+    if session_id is None:
+        return None
+    user = token_cache.get(session_id)
+    if user is not None:
+        return user
+    with login_db() as conn:
+        row = conn.execute('SELECT user_id, login, expires_at FROM sessions WHERE id = ? AND expires_at > ?',
+                           (session_id, time.time())).fetchone()
+    if row is None:
+        return None
+    user = {'user_id': row['user_id'], 'login': row['login']}
+    token_cache.put(session_id, user, row['expires_at'])
+    return user
+
+
+def revoke(token):
+    session_id = _session_id(token)
+    if session_id is None:
+        return False
+    token_cache.invalidate(session_id)
+    with login_db() as conn:
+        return conn.execute('DELETE FROM sessions WHERE id = ?', (session_id,)).rowcount > 0
+
+
+def rehash_plaintext(path=LOGIN_DB, chunk=REHASH_CHUNK, pause=REHASH_PAUSE):
+    # Hashes the passwords still stored in plain text by rows from before
+    # hashing, so they don't wait for their owner's next login. Hashing runs
+    # outside any transaction and each chunk is written in one short IMMEDIATE
+    # transaction; a row changed meanwhile (a login rehashed it) is left alone.
+    # Runs on this thread rather than the login pool, so it never makes
+    # /login answer busy.
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+    try:
+        last_id = 0
+        while True:
+            rows = conn.execute('''
+                SELECT id, password FROM personal_date
+                WHERE id > ? AND substr(password, 1, 14) != 'pbkdf2_sha256$'
+                ORDER BY id LIMIT ?
+            ''', (last_id, chunk)).fetchall()
+            if not rows:
+                break
+            hashed = [(_hash(password), user_id, password) for user_id, password in rows]
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany('UPDATE personal_date SET password = ? WHERE id = ? AND password = ?', hashed)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            last_id = rows[-1][0]
+            logging.debug(f"Password rehash at user {last_id}")
+            time.sleep(pause)
+    finally:
+        conn.close()
+
+
+def start_rehash(path=LOGIN_DB):
+    def run():
+        try:
+            rehash_plaintext(path)
+        except Exception:
+            logging.error('Password rehash failed; it resumes on the next start', exc_info=True)
+
+    thread = threading.Thread(target=run, name='password-rehash', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='[%(asctime)s | %(levelname)s: %(message)s]',
+                        datefmt='%Y.%m.%d %H:%M:%S', level=logging.DEBUG)
+    if sys.argv[1:2] == ['rehash']:
+        from migrations import run_migrations
+        run_migrations()
+        rehash_plaintext()
+    else:
+        print('usage: python auth.py rehash')
@@ -0,0 +1 @@
+# Benchmark suite for server.py. See bench/run.py for usage.
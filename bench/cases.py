@@ -0,0 +1,172 @@
+import base64
+import json
+from urllib.parse import urlencode
+
+from bench.fixtures import PASSWORD, WORDS
+
+# One request generator per endpoint. Each takes (rng, fixture) and returns
+# (method, path, body, headers) so the same request can go through Flask's test
+# client or a real HTTP connection. /stream is left out: it never completes.
+
+# A 1x1 PNG; uploads append random bytes so each one is a new file.
+PNG = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg==')
+
+
+def get(path, **params):
+    return 'GET', f'{path}?{urlencode(params)}' if params else path, None, {}
+
+
+def post_json(path, data):
+    return 'POST', path, json.dumps(data).encode('utf-8'), {'Content-Type': 'application/json'}
+
+
+def post_file(path, field, filename, content):
+    boundary = 'bench-boundary'
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode('utf-8') + content + \
+        f'\r\n--{boundary}--\r\n'.encode('utf-8')
+    return 'POST', path, body, {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+
+
+def _member_pair(rng, fx):
+    user_id = fx.user_id(rng)
+    return user_id, fx.chat_for(rng, user_id)
+
+
+def get_chats(rng, fx):
+    return get('/get_chats', user_id=fx.user_id(rng))
+
+
+def get_user_chats(rng, fx):
+    return get('/get_user_chats', user_id=fx.user_id(rng))
+
+
+def get_messages_latest(rng, fx):
+    user_id, chat_id = _member_pair(rng, fx)
+    return get('/get_messages', chat_id=chat_id, user_id=user_id)
+
+
+def get_messages_after(rng, fx):
+    user_id, chat_id = _member_pair(rng, fx)
+    return get('/get_messages', chat_id=chat_id, user_id=user_id, after_id=rng.randint(0, 1000))
+
+
+def get_messages_busy_chat(rng, fx):
+    chat_id = fx.busy_chat(rng)
+    return get('/get_messages', chat_id=chat_id, user_id=rng.choice(fx.members[chat_id]))
+
+
+def sync(rng, fx):
+    return get('/sync', user_id=fx.user_id(rng), since=rng.randint(0, 1000))
+
+
+def search(rng, fx):
+    return get('/search', user_id=fx.user_id(rng), q=rng.choice(WORDS))
+
+
+def send_message(rng, fx):
+    user_id, chat_id = _member_pair(rng, fx)
+    return post_json('/send_message', {'chat_id': chat_id, 'login': fx.logins[user_id - 1],
+                                       'message': f'bench {rng.random()}'})
+
+
+def send_messages(rng, fx):
+    user_id, chat_id = _member_pair(rng, fx)
+    return post_json('/send_messages', [{'chat_id': chat_id, 'login': fx.logins[user_id - 1],
+                                         'message': f'bench {i}'} for i in range(20)])
+
+
+def mark_messages_as_read(rng, fx):
+    user_id, chat_id = _member_pair(rng, fx)
+    return post_json('/mark_messages_as_read', {'chat_id': chat_id, 'user_id': user_id})
+
+
+def get_all_users(rng, fx):
+    return get('/get_all_users', prefix=f'user{rng.randint(1, 9)}', limit=50)
+
+
+def get_user_id(rng, fx):
+    return get('/get_user_id', login=rng.choice(fx.logins))
+
+
+def get_personal_date(rng, fx):
+    return get('/get_personal_date', login=rng.choice(fx.logins))
+
+
+def create_group_chat(rng, fx):
+    user_ids = rng.sample(fx.active_users, min(5, len(fx.active_users)))
+    return post_json('/create_group_chat', {'name': 'bench group', 'creator_id': user_ids[0],
+                                            'user_ids': user_ids[1:]})
+
+
+def create_private_chat(rng, fx):
+    # Mostly pairs that already have a chat, as in real use.
+    low, high = sorted(rng.sample(range(1, len(fx.logins) + 1), 2))
+    if rng.random() < 0.8:
+        chat_id = rng.choice(fx.chats)
+        if len(fx.members[chat_id]) == 2:
+            low, high = fx.members[chat_id]
+    return post_json('/create_private_chat', {'user1_id': low, 'user2_id': high})
+
+
+def add_user_to_chat(rng, fx):
+    chat_id = rng.choice(fx.chats[:fx.settings['group_chats']] or fx.chats)
+    return post_json('/add_user_to_chat', {'chat_id': chat_id, 'user_id': rng.randint(1, len(fx.logins)),
+                                           'adder_id': fx.members[chat_id][0]})
+
+
+def login(rng, fx):
+    return post_json('/login', {'login': rng.choice(fx.logins), 'password': PASSWORD})
+
+
+def set_personal_date(rng, fx):
+    return post_json('/set_personal_date', {'login': f'bench-{rng.getrandbits(64):x}', 'password': PASSWORD})
+
+
+def upload_image(rng, fx):
+    return post_file('/upload_image', 'file', 'bench.png', PNG + rng.getrandbits(64).to_bytes(8, 'big'))
+
+
+def uploaded_file(rng, fx):
+    return get(f'/uploads/{fx.upload}')
+
+
+def index(rng, fx):
+    return get('/')
+
+
+def pool_stats(rng, fx):
+    return get('/pool_stats')
+
+
+def metrics(rng, fx):
+    return get('/metrics')
+
+
+# name -> (generator, max requests per run or None). Password hashing makes
+# login and registration slow by design, so they run fewer iterations.
+CASES = {
+    'get_chats': (get_chats, None),
+    'get_user_chats': (get_user_chats, None),
+    'get_messages': (get_messages_latest, None),
+    'get_messages_after': (get_messages_after, None),
+    'get_messages_busy_chat': (get_messages_busy_chat, None),
+    'sync': (sync, None),
+    'search': (search, None),
+    'send_message': (send_message, None),
+    'send_messages': (send_messages, None),
+    'mark_messages_as_read': (mark_messages_as_read, None),
+    'get_all_users': (get_all_users, None),
+    'get_user_id': (get_user_id, None),
+    'get_personal_date': (get_personal_date, None),
+    'create_group_chat': (create_group_chat, None),
+    'create_private_chat': (create_private_chat, None),
+    'add_user_to_chat': (add_user_to_chat, None),
+    'login': (login, 20),
+    'set_personal_date': (set_personal_date, 20),
+    'upload_image': (upload_image, None),
+    'uploaded_file': (uploaded_file, None),
+    'index': (index, None),
+    'pool_stats': (pool_stats, None),
+    'metrics': (metrics, None),
+}
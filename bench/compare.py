@@ -0,0 +1,56 @@
+import argparse
+import json
+import sys
+
+# Compares two bench/run.py reports and exits non-zero when a case regressed:
+# p95 latency up, or throughput down, by more than the threshold.
+#   python -m bench.compare base.json new.json --threshold 0.1
+
+
+def compare(base, new, threshold):
+    rows, regressions = [], []
+    for name, after in new['results'].items():
+        before = base['results'].get(name)
+        if before is None:
+            continue
+        p95 = _change(before['p95_ms'], after['p95_ms'])
+        rps = _change(before['throughput_rps'], after['throughput_rps'])
+        regressed = p95 > threshold or rps < -threshold or after['errors'] > before['errors']
+        rows.append((name, before, after, p95, rps, regressed))
+        if regressed:
+            regressions.append(name)
+    return rows, regressions
+
+
+def _change(before, after):
+    return (after - before) / before if before else 0.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark reports')
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed relative change, 0.1 = 10%%')
+    args = parser.parse_args(argv)
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if base['meta']['scenario'] != new['meta']['scenario'] or base['meta']['driver'] != new['meta']['driver']:
+        print('warning: reports use different scenarios or drivers', file=sys.stderr)
+
+    rows, regressions = compare(base, new, args.threshold)
+    print(f'{"case":<26}{"p95 ms":>18}{"change":>9}{"rps":>20}{"change":>9}')
+    for name, before, after, p95, rps, regressed in rows:
+        print(f'{name:<26}{before["p95_ms"]:>8} -> {after["p95_ms"]:<6}{p95:>+9.1%}'
+              f'{before["throughput_rps"]:>9} -> {after["throughput_rps"]:<8}{rps:>+9.1%}'
+              f'{"  REGRESSION" if regressed else ""}')
+    if regressions:
+        print(f'{len(regressions)} regression(s): ' + ', '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
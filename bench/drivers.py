@@ -0,0 +1,78 @@
+import http.client
+import threading
+import time
+
+# Drivers send a list of (method, path, body, headers) requests and return
+# (wall seconds, [(latency seconds, status), ...]).
+
+
+class ClientDriver:
+    # Flask's test client in this thread: no sockets, so it measures the app alone.
+    name = 'client'
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def run(self, requests):
+        samples = []
+        started = time.perf_counter()
+        for method, path, body, headers in requests:
+            sent = time.perf_counter()
+            response = self.client.open(path, method=method, data=body, headers=headers)
+            response.get_data()
+            samples.append((time.perf_counter() - sent, response.status_code))
+        return time.perf_counter() - started, samples
+
+    def close(self):
+        pass
+
+
+class HTTPDriver:
+    # A threaded Werkzeug server on a free local port, driven by `threads`
+    # concurrent clients over real HTTP connections.
+    name = 'http'
+
+    def __init__(self, app, threads=8):
+        from werkzeug.serving import make_server
+        self.threads = threads
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.port = self.server.server_port
+        self._thread = threading.Thread(target=self.server.serve_forever, name='bench-http', daemon=True)
+        self._thread.start()
+
+    def _worker(self, requests, samples, lock):
+        while True:
+            with lock:
+                if not requests:
+                    return
+                method, path, body, headers = requests.pop()
+            connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+            sent = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except OSError:
+                status = 0
+            finally:
+                connection.close()
+            latency = time.perf_counter() - sent
+            with lock:
+                samples.append((latency, status))
+
+    def run(self, requests):
+        pending = list(reversed(requests))
+        samples = []
+        lock = threading.Lock()
+        workers = [threading.Thread(target=self._worker, args=(pending, samples, lock))
+                   for _ in range(self.threads)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return time.perf_counter() - started, samples
+
+    def close(self):
+        self.server.shutdown()
@@ -0,0 +1,129 @@
+import os
+import random
+import sqlite3
+from datetime import datetime
+
+import timestamps
+
+# Seeded chat.db/login.db fixtures. build() must run with the fixture directory
+# as the working directory, before server.py is imported: the app, its pools and
+# init_db() all use relative database paths.
+
+SCENARIOS = {
+    'small': {'users': 200, 'group_chats': 50, 'private_chats': 100, 'group_min': 3, 'group_max': 20,
+              'messages_per_chat': 100, 'skew': 1.1},
+    'medium': {'users': 5000, 'group_chats': 1000, 'private_chats': 3000, 'group_min': 3, 'group_max': 50,
+               'messages_per_chat': 100, 'skew': 1.1},
+    'large': {'users': 50000, 'group_chats': 10000, 'private_chats': 30000, 'group_min': 3, 'group_max': 200,
+              'messages_per_chat': 100, 'skew': 1.2},
+}
+
+PASSWORD = 'bench'
+WORDS = ('hello', 'duck', 'meeting', 'tomorrow', 'lunch', 'release', 'deploy', 'photo', 'weekend', 'coffee',
+         'report', 'budget', 'thanks', 'question', 'server', 'bug', 'review', 'ticket', 'call', 'later')
+
+
+class Fixture:
+    # What request generators need to pick realistic targets.
+    def __init__(self, settings, logins, chats, members, user_chats, chat_weights):
+        self.settings = settings
+        self.logins = logins
+        self.chats = chats
+        self.members = members
+        self.user_chats = user_chats
+        self.chat_weights = chat_weights
+        # Users that belong to at least one chat, so reads pass the membership check.
+        self.active_users = sorted(user_chats)
+        self.upload = None
+
+    def user_id(self, rng):
+        return rng.choice(self.active_users)
+
+    def chat_for(self, rng, user_id):
+        return rng.choice(self.user_chats[user_id])
+
+    def busy_chat(self, rng):
+        return rng.choices(self.chats, self.chat_weights)[0]
+
+
+def _message_text(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 12)))
+
+
+def build(directory, scenario='small', seed=0, **overrides):
+    import auth
+    from chat import init_db as init_chat_db
+    from login import init_db as init_login_db
+    from migrations import run_migrations
+
+    settings = dict(SCENARIOS[scenario], **{k: v for k, v in overrides.items() if v is not None})
+    rng = random.Random(seed)
+    os.chdir(directory)
+    init_chat_db()
+    init_login_db()
+    run_migrations()
+
+    users = settings['users']
+    logins = [f'user{i}' for i in range(users)]
+    password_hash = auth.hash_password(PASSWORD)
+    login_conn = sqlite3.connect('login.db')
+    login_conn.executemany('INSERT INTO personal_date (id, login, password) VALUES (?, ?, ?)',
+                           [(i + 1, login, password_hash) for i, login in enumerate(logins)])
+    login_conn.commit()
+    login_conn.close()
+
+    created_at = datetime(2024, 1, 1)
+    created_ms = int(created_at.timestamp() * 1000)
+    created_text = timestamps.legacy_text(created_ms)
+    chat_rows, member_rows, direct_rows = [], [], []
+    members = {}
+    for chat_id in range(1, settings['group_chats'] + 1):
+        size = min(users, rng.randint(settings['group_min'], settings['group_max']))
+        members[chat_id] = rng.sample(range(1, users + 1), size)
+        chat_rows.append((chat_id, f'group {chat_id}', 0, members[chat_id][0], created_text, created_ms))
+    pairs = set()
+    while len(pairs) < min(settings['private_chats'], users * (users - 1) // 2):
+        pair = tuple(sorted(rng.sample(range(1, users + 1), 2)))
+        pairs.add(pair)
+    for chat_id, (low, high) in enumerate(sorted(pairs), settings['group_chats'] + 1):
+        members[chat_id] = [low, high]
+        chat_rows.append((chat_id, f'Private chat {low}-{high}', 1, low, created_text, created_ms))
+        direct_rows.append((low, high, chat_id))
+    for chat_id, user_ids in members.items():
+        member_rows.extend((chat_id, user_id) for user_id in user_ids)
+
+    # Activity is Zipf-distributed: a few chats get most of the messages.
+    chats = list(members)
+    ranks = list(range(1, len(chats) + 1))
+    rng.shuffle(ranks)
+    chat_weights = [1 / rank ** settings['skew'] for rank in ranks]
+    total = len(chats) * settings['messages_per_chat']
+    message_rows = []
+    for index, chat_id in enumerate(rng.choices(chats, chat_weights, k=total)):
+        sent_ms = created_ms + index * 7000
+        message_rows.append((chat_id, _message_text(rng), timestamps.legacy_text(sent_ms), sent_ms,
+                             logins[rng.choice(members[chat_id]) - 1]))
+
+    chat_conn = sqlite3.connect('chat.db')
+    chat_conn.executemany('''
+        INSERT INTO chats (id, name, is_private, creator_id, created_at, created_ms) VALUES (?, ?, ?, ?, ?, ?)
+    ''', chat_rows)
+    chat_conn.executemany('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)', member_rows)
+    chat_conn.executemany('INSERT INTO direct_chats (user_low, user_high, chat_id) VALUES (?, ?, ?)', direct_rows)
+    chat_conn.executemany('''
+        INSERT INTO messages (chat_id, message, timestamp, created_ms, login) VALUES (?, ?, ?, ?, ?)
+    ''', message_rows)
+    # Most members are caught up; some are a few messages behind.
+    chat_conn.execute('''
+        UPDATE chat_members SET last_read_message_id = MAX(0, COALESCE(
+            (SELECT MAX(id) FROM messages WHERE messages.chat_id = chat_members.chat_id), 0) - (id * 7919) % 20)
+    ''')
+    chat_conn.commit()
+    chat_conn.execute('ANALYZE')
+    chat_conn.close()
+
+    user_chats = {}
+    for chat_id, user_ids in members.items():
+        for user_id in user_ids:
+            user_chats.setdefault(user_id, []).append(chat_id)
+    return Fixture(settings, logins, chats, members, user_chats, chat_weights)
@@ -0,0 +1,155 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench import cases, fixtures
+from bench.drivers import ClientDriver, HTTPDriver
+
+# Per-endpoint throughput and latency benchmark for server.py. Builds seeded
+# databases in a temp directory, replays generated requests and writes JSON that
+# bench/compare.py can diff against another run:
+#   python -m bench --scenario small --out base.json
+#   python -m bench --scenario medium --driver http --threads 16 --cases get_chats,get_messages
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def summarize(seconds, samples):
+    # 304 is a successful answer to a conditional request, not an error.
+    latencies = [latency * 1000 for latency, _ in samples]
+    errors = sum(1 for _, status in samples if status >= 400 or status == 0)
+    return {
+        'requests': len(samples),
+        'errors': errors,
+        'seconds': round(seconds, 4),
+        'throughput_rps': round(len(samples) / seconds, 1) if seconds else 0.0,
+        'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_upload(app, fx):
+    # uploaded_file needs something to serve.
+    client = app.test_client()
+    method, path, body, headers = cases.upload_image(random.Random(0), fx)
+    response = client.open(path, method=method, data=body, headers=headers)
+    fx.upload = response.get_json()['image_url'].rsplit('/', 1)[-1]
+
+
+def run_cases(driver, fx, names, requests, warmup, seed):
+    results = {}
+    for name in names:
+        generate, cap = cases.CASES[name]
+        count = min(requests, cap) if cap else requests
+        rng = random.Random(f'{seed}-{name}')
+        if warmup:
+            driver.run([generate(rng, fx) for _ in range(min(warmup, count))])
+        seconds, samples = driver.run([generate(rng, fx) for _ in range(count)])
+        results[name] = summarize(seconds, samples)
+    return results
+
+
+def print_table(results):
+    print(f'{"case":<26}{"req":>7}{"err":>6}{"rps":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for name, result in results.items():
+        print(f'{name:<26}{result["requests"]:>7}{result["errors"]:>6}{result["throughput_rps"]:>10}'
+              f'{result["p50_ms"]:>10}{result["p95_ms"]:>10}{result["p99_ms"]:>10}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='HTTP API benchmark')
+    parser.add_argument('--scenario', choices=sorted(fixtures.SCENARIOS), default='small')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=500, help='measured requests per case')
+    parser.add_argument('--warmup', type=int, default=50, help='unmeasured requests per case')
+    parser.add_argument('--driver', choices=('client', 'http'), default='client')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent clients for --driver http')
+    parser.add_argument('--cases', help='comma-separated subset of: ' + ', '.join(cases.CASES))
+    parser.add_argument('--out', help='write results as JSON to this file')
+    parser.add_argument('--keep', action='store_true', help='keep the fixture directory')
+    for key in ('users', 'group_chats', 'private_chats', 'group_min', 'group_max', 'messages_per_chat'):
+        parser.add_argument('--' + key.replace('_', '-'), dest=key, type=int, help='override the scenario')
+    parser.add_argument('--skew', type=float, help='override the scenario')
+    args = parser.parse_args(argv)
+
+    names = args.cases.split(',') if args.cases else list(cases.CASES)
+    unknown = [name for name in names if name not in cases.CASES]
+    if unknown:
+        parser.error('unknown cases: ' + ', '.join(unknown))
+    out = os.path.abspath(args.out) if args.out else None
+
+    sys.path.insert(0, REPO)
+    directory = tempfile.mkdtemp(prefix='bench_')
+    try:
+        started = time.time()
+        fx = fixtures.build(directory, args.scenario, args.seed,
+                            **{key: getattr(args, key) for key in ('users', 'group_chats', 'private_chats',
+                                                                   'group_min', 'group_max',
+                                                                   'messages_per_chat', 'skew')})
+        print(f'fixture {args.scenario} built in {time.time() - started:.1f}s in {directory}', file=sys.stderr)
+
+        # Imported only now: the app opens its databases relative to the cwd.
+        from server import app
+        logging.getLogger().setLevel(logging.WARNING)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+        prepare_upload(app, fx)
+
+        driver = HTTPDriver(app, args.threads) if args.driver == 'http' else ClientDriver(app)
+        try:
+            results = run_cases(driver, fx, names, args.requests, args.warmup, args.seed)
+        finally:
+            driver.close()
+    finally:
+        os.chdir(REPO)
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'scenario': args.scenario,
+            'settings': fx.settings,
+            'seed': args.seed,
+            'driver': args.driver,
+            'threads': args.threads if args.driver == 'http' else 1,
+            'requests': args.requests,
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    print_table(results)
+    if out:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    main()
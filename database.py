@@ -0,0 +1,225 @@
+import os
+import sqlite3
+import threading
+import time
+import queue
+import logging
+from contextlib import contextmanager
+
+import metrics
+
+CHAT_DB = 'chat.db'
+LOGIN_DB = 'login.db'
+
+POOL_SIZE = 8
+POOL_TIMEOUT = 10.0
+BUSY_TIMEOUT_MS = 5000
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KB = 16000
+CACHED_STATEMENTS = 256
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class TimedCursor(sqlite3.Cursor):
+    # Charges execute and fetch* time to the statement in metrics.registry.
+    # Rows read by iterating the cursor directly are not timed.
+    db = None
+    sql = None
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.sql = sql
+            metrics.registry.observe_sql(self.db, sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.sql = sql
+            metrics.registry.observe_sql(self.db, sql, time.perf_counter() - started)
+
+    def _timed_fetch(self, fetch, *args):
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            if self.sql is not None:
+                metrics.registry.observe_sql(self.db, self.sql, time.perf_counter() - started)
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed_fetch(super().fetchmany, *(() if size is None else (size,)))
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+
+class TimedConnection(sqlite3.Connection):
+    # Connection.execute() doesn't go through cursor(), so both are overridden.
+    db = None
+
+    def cursor(self, factory=TimedCursor):
+        cursor = super().cursor(factory)
+        cursor.db = self.db
+        return cursor
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class ConnectionPool:
+    def __init__(self, path, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._acquired = 0
+        self._hits = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                               cached_statements=CACHED_STATEMENTS,
+                               factory=TimedConnection if metrics.ENABLED else sqlite3.Connection)
+        if isinstance(conn, TimedConnection):
+            conn.db = os.path.splitext(os.path.basename(self.path))[0]
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+        conn.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+        conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+        logging.debug(f"Opened pooled connection to {self.path}")
+        return conn
+
+    def acquire(self):
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self._hits += 1
+                self._acquired += 1
+                self._in_use += 1
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+
+        if create:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+            with self._lock:
+                self._acquired += 1
+                self._in_use += 1
+            return conn
+
+        started = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            with self._lock:
+                self._timeouts += 1
+            raise PoolTimeout(f"No free connection to {self.path} after {self.timeout}s")
+        with self._lock:
+            self._waits += 1
+            self._wait_time += time.perf_counter() - started
+            self._acquired += 1
+            self._in_use += 1
+        return conn
+
+    def release(self, conn):
+        with self._lock:
+            self._in_use -= 1
+        self._idle.put(conn)
+
+    def discard(self, conn):
+        with self._lock:
+            self._in_use -= 1
+            self._created -= 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                self.discard(conn)
+                raise
+            self.release(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def close(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'path': self.path,
+                'size': self._created,
+                'max_size': self.size,
+                'idle': self._idle.qsize(),
+                'in_use': self._in_use,
+                'acquired': self._acquired,
+                'hits': self._hits,
+                'hit_rate': self._hits / self._acquired if self._acquired else 0.0,
+                'waits': self._waits,
+                'wait_time_total': self._wait_time,
+                'timeouts': self._timeouts,
+            }
+
+
+chat_pool = ConnectionPool(CHAT_DB)
+login_pool = ConnectionPool(LOGIN_DB)
+
+
+def chat_db():
+    return chat_pool.connection()
+
+
+def login_db():
+    return login_pool.connection()
+
+
+def pool_stats():
+    return {'chat': chat_pool.stats(), 'login': login_pool.stats()}
@@ -0,0 +1,109 @@
+import bisect
+import threading
+import time
+
+from database import login_db
+
+REFRESH_INTERVAL = 1.0
+# A lookup that misses re-reads sooner than REFRESH_INTERVAL, but at most this
+# often: lookups of logins that don't exist would otherwise each cost a query.
+MISS_REFRESH_INTERVAL = 0.1
+
+
+class UserDirectory:
+    # id <-> login index of personal_date, held in memory. Accounts are only
+    # ever added, so after the initial load the directory catches up with a
+    # primary-key range read past the highest id it has seen; that also picks
+    # up users registered through another process.
+    def __init__(self, refresh_interval=REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._by_id = {}
+        self._by_login = {}
+        self._logins = []
+        self._max_id = 0
+        self._loaded = False
+        self._refreshed_at = 0.0
+
+    def _add(self, user_id, login):
+        if user_id in self._by_id:
+            return
+        self._by_id[user_id] = login
+        self._by_login[login] = user_id
+        bisect.insort(self._logins, login)
+        self._max_id = max(self._max_id, user_id)
+
+    def refresh(self, force=False):
+        self._refresh(0.0 if force else self.refresh_interval)
+
+    def _refresh(self, max_age):
+        # Serialized, so callers that find the directory stale together wait
+        # for one read instead of each issuing their own.
+        with self._refresh_lock:
+            now = time.monotonic()
+            if self._loaded and now - self._refreshed_at < max_age:
+                return
+            with login_db() as conn:
+                rows = conn.execute('SELECT id, login FROM personal_date WHERE id > ? ORDER BY id',
+                                    (self._max_id,)).fetchall()
+            with self._lock:
+                for row in rows:
+                    self._add(row['id'], row['login'])
+                self._loaded = True
+                self._refreshed_at = now
+
+    def add(self, user_id, login):
+        with self._lock:
+            self._add(int(user_id), login)
+
+    def get_id(self, login):
+        self.refresh()
+        user_id = self._by_login.get(login)
+        if user_id is None:
+            # Might have registered elsewhere since the last refresh.
+            self._refresh(MISS_REFRESH_INTERVAL)
+            user_id = self._by_login.get(login)
+        return user_id
+
+    def get_login(self, user_id):
+        self.refresh()
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        login = self._by_id.get(user_id)
+        if login is None and user_id > self._max_id:
+            self._refresh(MISS_REFRESH_INTERVAL)
+            login = self._by_id.get(user_id)
+        return login
+
+    def exists(self, user_id):
+        return self.get_login(user_id) is not None
+
+    def version(self):
+        # Ids only grow, so (highest id, count) changes exactly when the directory does.
+        self.refresh()
+        with self._lock:
+            return f'users-{self._max_id}-{len(self._by_id)}'
+
+    def page(self, prefix='', limit=None, after=None):
+        # Users ordered by login, optionally restricted to a login prefix.
+        # Returns (users, next_cursor); the cursor is the last login returned.
+        self.refresh()
+        with self._lock:
+            if after is not None and after >= prefix:
+                start = bisect.bisect_right(self._logins, after)
+            else:
+                start = bisect.bisect_left(self._logins, prefix)
+            users = []
+            for login in self._logins[start:]:
+                if not login.startswith(prefix):
+                    break
+                if limit is not None and len(users) == limit:
+                    return users, users[-1]['login']
+                users.append({'id': self._by_login[login], 'login': login})
+            return users, None
+
+
+user_directory = UserDirectory()
@@ -0,0 +1,97 @@
+import json
+import queue
+import threading
+import logging
+
+SUBSCRIBER_QUEUE_SIZE = 256
+HEARTBEAT_INTERVAL = 15.0
+
+
+class Subscription:
+    def __init__(self, hub, user_id, maxsize):
+        self.hub = hub
+        self.user_id = user_id
+        self.dropped = False
+        self._queue = queue.Queue(maxsize=maxsize)
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except queue.Full:
+            # A consumer that can't keep up is cut off; it resumes with Last-Event-ID.
+            self.dropped = True
+            self.hub.unsubscribe(self)
+            logging.warning(f"Dropped slow event subscriber for user {self.user_id}")
+            return False
+
+    def get(self, timeout):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Hub:
+    def __init__(self, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._published = 0
+        self._delivered = 0
+        self._dropped = 0
+
+    def subscribe(self, user_id):
+        subscription = Subscription(self, int(user_id), self.queue_size)
+        with self._lock:
+            self._subscribers.setdefault(subscription.user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscribers.get(subscription.user_id)
+            if subscriptions and subscription in subscriptions:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscribers[subscription.user_id]
+                if subscription.dropped:
+                    self._dropped += 1
+
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+    def publish(self, user_ids, event):
+        targets = []
+        with self._lock:
+            self._published += 1
+            for user_id in user_ids:
+                try:
+                    targets.extend(self._subscribers.get(int(user_id), ()))
+                except (TypeError, ValueError):
+                    continue
+        delivered = sum(1 for subscription in targets if subscription.put(event))
+        with self._lock:
+            self._delivered += delivered
+        return delivered
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._subscribers),
+                'subscribers': sum(len(s) for s in self._subscribers.values()),
+                'published': self._published,
+                'delivered': self._delivered,
+                'dropped': self._dropped,
+            }
+
+
+def format_sse(event):
+    lines = []
+    if event.get('id') is not None:
+        lines.append(f"id: {event['id']}")
+    lines.append(f"event: {event['event']}")
+    lines.append(f"data: {json.dumps(event['data'], ensure_ascii=False)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+hub = Hub()
@@ -0,0 +1,242 @@
+import asyncio
+import json
+import logging
+import resource
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import websockets
+
+import auth
+import store
+import timestamps
+from database import chat_db
+from logs import setup_logging
+from membership import membership_cache
+from migrations import run_migrations
+from writer import write_message
+
+HOST = '0.0.0.0'
+PORT = 5001
+DB_WORKERS = 8
+DB_QUEUE_LIMIT = 64
+TAIL_INTERVAL = 0.25
+TAIL_BATCH = 500
+AUTH_TIMEOUT = 10.0
+
+# WebSocket gateway that runs alongside the Flask app and shares its databases.
+#
+# Client frames:  {"type": "auth", "token": ...} or {"type": "auth", "login": ..., "password": ...}
+#                 {"type": "send", "ref": ..., "chat_id": ..., "message": ..., "image_url": ...}
+#                 {"type": "mark_read", "ref": ..., "chat_id": ..., "message_id": ...}
+# Server frames:  {"type": "auth_ok", "user_id": ...}
+#                 {"type": "ack", "ref": ..., "id": ...}
+#                 {"type": "message", "message": {...}}
+#                 {"type": "error", "ref": ..., "message": ...}
+#
+# New messages reach clients through one process-wide tailer that follows
+# messages.id, so messages written by server.py are delivered too.
+
+
+class Gateway:
+    def __init__(self, db_workers=DB_WORKERS, db_queue_limit=DB_QUEUE_LIMIT):
+        self._executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix='gateway-db')
+        self._db_slots = asyncio.Semaphore(db_queue_limit)
+        self._connections = {}
+        self._wake = asyncio.Event()
+        self._last_id = None
+        self._sends = set()
+        self.stats = {'connections': 0, 'peak_connections': 0, 'received': 0, 'delivered': 0}
+
+    async def run_db(self, fn, *args):
+        # The semaphore bounds queued work so a burst can't grow the executor queue without limit.
+        async with self._db_slots:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _register(self, user_id, websocket):
+        self._connections.setdefault(user_id, set()).add(websocket)
+        self.stats['connections'] += 1
+        self.stats['peak_connections'] = max(self.stats['peak_connections'], self.stats['connections'])
+        self._wake.set()
+
+    def _unregister(self, user_id, websocket):
+        sockets = self._connections.get(user_id)
+        if sockets:
+            sockets.discard(websocket)
+            if not sockets:
+                del self._connections[user_id]
+        self.stats['connections'] -= 1
+
+    async def handler(self, websocket):
+        user = await self._authenticate(websocket)
+        if user is None:
+            return
+        self._register(user['id'], websocket)
+        try:
+            async for raw in websocket:
+                self.stats['received'] += 1
+                try:
+                    frame = json.loads(raw)
+                except ValueError:
+                    await websocket.send(json.dumps({'type': 'error', 'message': 'Invalid JSON'}))
+                    continue
+                await self._dispatch(websocket, user, frame)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self._unregister(user['id'], websocket)
+
+    async def _authenticate(self, websocket):
+        try:
+            frame = json.loads(await asyncio.wait_for(websocket.recv(), AUTH_TIMEOUT))
+        except (asyncio.TimeoutError, ValueError, websockets.ConnectionClosed):
+            await websocket.close(code=4001, reason='auth required')
+            return None
+        user = None
+        if frame.get('type') == 'auth' and frame.get('token'):
+            user = await self.run_db(_resolve_token, frame['token'])
+        elif frame.get('type') == 'auth' and frame.get('login') and frame.get('password'):
+            user = await self.run_db(_authenticate, frame['login'], frame['password'])
+        if not user:
+            await websocket.send(json.dumps({'type': 'error', 'message': 'Invalid login or password'}))
+            await websocket.close(code=4003, reason='auth failed')
+            return None
+        await websocket.send(json.dumps({'type': 'auth_ok', 'user_id': user['id']}))
+        return user
+
+    async def _dispatch(self, websocket, user, frame):
+        kind = frame.get('type')
+        ref = frame.get('ref')
+        chat_id = store.parse_id(frame.get('chat_id'))
+        try:
+            if chat_id is None and frame.get('chat_id') not in (None, ''):
+                raise ValueError('Invalid chat_id')
+            if kind == 'send':
+                if not chat_id or not (frame.get('message') or frame.get('image_url')):
+                    raise ValueError('No message or chat_id provided')
+                stored = await self.run_db(_send_message, user, chat_id, frame.get('message'),
+                                           frame.get('image_url'))
+                if stored is None:
+                    raise PermissionError('Access denied')
+                await websocket.send(json.dumps({'type': 'ack', 'ref': ref, 'id': stored['id']}))
+                self._wake.set()
+            elif kind == 'mark_read':
+                if not chat_id:
+                    raise ValueError('No chat_id provided')
+                message_id = store.parse_id(frame.get('message_id'))
+                if message_id is None and frame.get('message_id') not in (None, ''):
+                    raise ValueError('message_id must be an integer')
+                if not await self.run_db(_mark_read, chat_id, user['id'], message_id):
+                    raise PermissionError('Access denied')
+                await websocket.send(json.dumps({'type': 'ack', 'ref': ref}))
+            else:
+                raise ValueError(f'Unknown frame type {kind!r}')
+        except (ValueError, PermissionError) as e:
+            await websocket.send(json.dumps({'type': 'error', 'ref': ref, 'message': str(e)}))
+        except Exception as e:
+            logging.error(f"Gateway error handling {kind}: {e}", exc_info=True)
+            await websocket.send(json.dumps({'type': 'error', 'ref': ref, 'message': 'Internal error'}))
+
+    async def tail(self):
+        self._last_id = await self.run_db(_max_message_id)
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), TAIL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if not self._connections:
+                continue
+            try:
+                messages, members = await self.run_db(_new_messages, self._last_id)
+            except Exception as e:
+                logging.error(f"Gateway tailer failed: {e}", exc_info=True)
+                continue
+            for message in messages:
+                self._last_id = message['id']
+                frame = json.dumps({'type': 'message', 'message': message}, ensure_ascii=False)
+                for user_id in members.get(message['chat_id'], ()):
+                    for websocket in list(self._connections.get(user_id, ())):
+                        self.stats['delivered'] += 1
+                        task = asyncio.ensure_future(_send_quietly(websocket, frame))
+                        self._sends.add(task)
+                        task.add_done_callback(self._sends.discard)
+            if len(messages) == TAIL_BATCH:
+                self._wake.set()
+
+
+async def _send_quietly(websocket, frame):
+    try:
+        await websocket.send(frame)
+    except websockets.ConnectionClosed:
+        pass
+
+
+def _authenticate(login, password):
+    try:
+        return auth.authenticate(login, password)
+    except auth.HashingBusy:
+        return None
+
+
+def _resolve_token(token):
+    user = auth.resolve(token)
+    return {'id': user['user_id'], 'login': user['login']} if user else None
+
+
+def _send_message(user, chat_id, message, image_url):
+    if not membership_cache.is_member(chat_id, user['id']):
+        return None
+    return write_message(chat_id, message, user['login'], image_url)
+
+
+def _mark_read(chat_id, user_id, message_id):
+    with chat_db() as conn:
+        return store.mark_read(conn, chat_id, user_id, message_id)
+
+
+def _max_message_id():
+    with chat_db() as conn:
+        return conn.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+
+
+def _new_messages(last_id):
+    with chat_db() as conn:
+        messages = [timestamps.message_out(dict(row)) for row in conn.execute(
+            'SELECT * FROM messages WHERE id > ? ORDER BY id LIMIT ?', (last_id, TAIL_BATCH))]
+        members = {}
+        chat_ids = {message['chat_id'] for message in messages}
+        for chat_id in chat_ids:
+            members[chat_id] = store.chat_member_ids(conn, chat_id)
+    return messages, members
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+async def serve(host=HOST, port=PORT, ready=None):
+    gateway = Gateway()
+    tailer = asyncio.ensure_future(gateway.tail())
+    # No per-message compression: its buffers dominate per-connection memory.
+    async with websockets.serve(gateway.handler, host, port, compression=None,
+                                max_size=2 ** 16, ping_interval=30, ping_timeout=30):
+        if ready is not None:
+            ready.set_result(gateway)
+        try:
+            await asyncio.Future()
+        finally:
+            tailer.cancel()
+
+
+if __name__ == '__main__':
+    # Keeps console writes off the event loop thread.
+    setup_logging(log_file=None)
+    run_migrations()
+    limit = raise_fd_limit()
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+    logging.info(f"WebSocket gateway listening on {HOST}:{port} (fd limit {limit})")
+    asyncio.run(serve(HOST, port))
@@ -0,0 +1,37 @@
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FILE = 'chat.log'
+LOG_FORMAT = '[%(asctime)s | %(levelname)s: %(message)s]'
+DATE_FORMAT = '%Y.%m.%d %H:%M:%S'
+
+_listener = None
+
+
+def setup_logging(level=logging.INFO, log_file=LOG_FILE):
+    # Request threads only put records on a queue; formatting and the file and
+    # console writes happen on the listener's thread.
+    global _listener
+    if _listener is not None:
+        return _listener
+    formatter = logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level)
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    # Flushes whatever is still queued on shutdown.
+    atexit.register(_listener.stop)
+    return _listener
@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+
+from database import chat_db
+
+MEMBERSHIP_CACHE_SIZE = 50000
+MEMBERSHIP_CACHE_TTL = 60.0
+# A chat missing from a cached set is re-read at most this often, so a member
+# added by another process (or before an invalidation lands) is seen quickly.
+NEGATIVE_RECHECK = 1.0
+
+
+class MembershipCache:
+    # LRU of user id -> set of chat ids the user belongs to. Membership changes
+    # made by this process invalidate the affected users directly; the TTL is
+    # the safety net for changes made elsewhere.
+    def __init__(self, size=MEMBERSHIP_CACHE_SIZE, ttl=MEMBERSHIP_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def _load(self, user_id):
+        with self._lock:
+            generation = self._generation
+        with chat_db() as conn:
+            chat_ids = frozenset(row['chat_id'] for row in conn.execute(
+                'SELECT chat_id FROM chat_members WHERE user_id = ?', (user_id,)))
+        with self._lock:
+            # Don't cache a set read before an invalidation that raced with it.
+            if generation == self._generation:
+                self._entries[user_id] = (chat_ids, time.monotonic())
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return chat_ids
+
+    def chat_ids(self, user_id):
+        user_id = int(user_id)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl:
+                self._entries.move_to_end(user_id)
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+        return self._load(user_id)
+
+    def is_member(self, chat_id, user_id):
+        chat_id, user_id = int(chat_id), int(user_id)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            now = time.monotonic()
+            if entry is not None and now - entry[1] < self.ttl:
+                if chat_id in entry[0] or now - entry[1] < NEGATIVE_RECHECK:
+                    self._entries.move_to_end(user_id)
+                    self._hits += 1
+                    return chat_id in entry[0]
+            self._misses += 1
+        return chat_id in self._load(user_id)
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            self._generation += 1
+            for user_id in user_ids:
+                self._entries.pop(int(user_id), None)
+                self._invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'users': len(self._entries),
+                'capacity': self.size,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else 0.0,
+                'invalidations': self._invalidations,
+            }
+
+
+membership_cache = MembershipCache()
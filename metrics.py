@@ -0,0 +1,172 @@
+import re
+import threading
+
+# Request and SQL instrumentation, rendered in the Prometheus text format by
+# server.py's /metrics. Recording is a lock, a dict lookup and a bucket
+# increment, cheap enough to leave on.
+
+ENABLED = True
+
+# Upper bounds in seconds; the last bucket (+Inf) is implicit.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+MAX_STATEMENTS = 1000
+
+_IN_LIST = re.compile(r'\bIN\s*\(\s*\?(\s*,\s*\?)*\s*\)', re.IGNORECASE)
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(BUCKETS) and value > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        # Linear interpolation inside the bucket holding the q-th observation,
+        # the same estimate Prometheus' histogram_quantile() makes.
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = BUCKETS[index - 1] if index else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else self.max
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._latency = {}
+        self._in_flight = {}
+        self._statements = {}
+        self._normalized = {}
+
+    def request_started(self, route):
+        with self._lock:
+            self._in_flight[route] = self._in_flight.get(route, 0) + 1
+
+    def request_finished(self, route, method, status, seconds):
+        with self._lock:
+            self._in_flight[route] -= 1
+            key = (route, method, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            histogram = self._latency.get(route)
+            if histogram is None:
+                histogram = self._latency[route] = Histogram()
+            histogram.observe(seconds)
+
+    def normalize(self, sql):
+        # Statements are parameterized already; only whitespace and the length
+        # of IN (?, ?, ...) lists vary between calls of the same query.
+        normalized = self._normalized.get(sql)
+        if normalized is None:
+            normalized = _IN_LIST.sub('IN (?...)', ' '.join(sql.split()))
+            if len(self._normalized) < MAX_STATEMENTS * 4:
+                self._normalized[sql] = normalized
+        return normalized
+
+    def observe_sql(self, db, sql, seconds):
+        statement = self.normalize(sql)
+        with self._lock:
+            key = (db, statement)
+            histogram = self._statements.get(key)
+            if histogram is None:
+                if len(self._statements) >= MAX_STATEMENTS:
+                    key = (db, 'other')
+                    histogram = self._statements.get(key)
+                if histogram is None:
+                    histogram = self._statements[key] = Histogram()
+            histogram.observe(seconds)
+
+    def render(self, gauges=()):
+        # gauges: (name, help, {labels tuple: value}) added alongside our own series.
+        with self._lock:
+            requests = dict(self._requests)
+            latency = {route: _copy(h) for route, h in self._latency.items()}
+            in_flight = dict(self._in_flight)
+            statements = {key: _copy(h) for key, h in self._statements.items()}
+
+        lines = []
+        _family(lines, 'duckchat_http_requests_total', 'counter', 'HTTP requests by route, method and status.')
+        for (route, method, status), count in sorted(requests.items()):
+            lines.append(f'duckchat_http_requests_total{_labels(route=route, method=method, status=status)} {count}')
+        _family(lines, 'duckchat_http_requests_in_flight', 'gauge', 'HTTP requests being handled.')
+        for route, count in sorted(in_flight.items()):
+            lines.append(f'duckchat_http_requests_in_flight{_labels(route=route)} {count}')
+        _histograms(lines, 'duckchat_http_request_duration_seconds', 'HTTP request latency.',
+                    {(('route', route),): h for route, h in latency.items()})
+        _histograms(lines, 'duckchat_sql_statement_duration_seconds',
+                    'SQL execute and fetch time per normalized statement.',
+                    {(('db', db), ('statement', statement)): h for (db, statement), h in statements.items()})
+        for name, help_text, values in gauges:
+            _family(lines, name, 'gauge', help_text)
+            for labels, value in sorted(values.items()):
+                lines.append(f'{name}{_labels(**dict(labels))} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _copy(histogram):
+    copy = Histogram()
+    copy.counts = list(histogram.counts)
+    copy.count, copy.total, copy.max = histogram.count, histogram.total, histogram.max
+    return copy
+
+
+def _family(lines, name, kind, help_text):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} {kind}')
+
+
+def _histograms(lines, name, help_text, histograms):
+    _family(lines, name, 'histogram', help_text)
+    for labels, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{_labels(*labels, ("le", bound))} {cumulative}')
+        lines.append(f'{name}_sum{_labels(*labels)} {_number(histogram.total)}')
+        lines.append(f'{name}_count{_labels(*labels)} {histogram.count}')
+    # Precomputed quantile estimates for reading /metrics without a Prometheus server.
+    _family(lines, f'{name}_quantile', 'gauge', f'{help_text} Estimated quantiles.')
+    for labels, histogram in sorted(histograms.items()):
+        for q in QUANTILES:
+            lines.append(f'{name}_quantile{_labels(*labels, ("quantile", q))} {_number(histogram.quantile(q))}')
+
+
+def _labels(*pairs, **labels):
+    items = list(pairs) + list(labels.items())
+    if not items:
+        return ''
+    rendered = ','.join(f'{key}="{_escape(value)}"' for key, value in items)
+    return '{' + rendered + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
@@ -0,0 +1,352 @@
+import sqlite3
+import sys
+import logging
+from datetime import datetime
+from chat import init_db as init_chat_db
+from login import init_db as init_login_db
+from database import CHAT_DB, LOGIN_DB
+import search
+import uploads
+import thumbnails
+import auth
+import timestamps
+
+
+def _dedupe_chat_members(conn):
+    cursor = conn.execute('''
+        DELETE FROM chat_members WHERE id NOT IN (
+            SELECT MIN(id) FROM chat_members GROUP BY chat_id, user_id
+        )
+    ''')
+    if cursor.rowcount:
+        logging.warning(f"Removed {cursor.rowcount} duplicate chat_members rows")
+
+
+def _dedupe_logins(conn):
+    # Before the unique index, /login matched login and password together, so
+    # a repeated login could be a separate account with its own chats. The
+    # oldest keeps the login; the others are renamed to '<login>~<id>', which
+    # keeps their chats and lets an operator tell them their new login.
+    duplicates = conn.execute('''
+        SELECT id, login FROM personal_date WHERE id NOT IN (
+            SELECT MIN(id) FROM personal_date GROUP BY login
+        )
+    ''').fetchall()
+    for user_id, login in duplicates:
+        renamed = f'{login}~{user_id}'
+        while conn.execute('SELECT 1 FROM personal_date WHERE login = ?', (renamed,)).fetchone():
+            renamed += '~'
+        conn.execute('UPDATE personal_date SET login = ? WHERE id = ?', (renamed, user_id))
+        logging.warning(f"Duplicate login {login!r}: account {user_id} renamed to {renamed!r}")
+
+
+# (version, name, steps); a step is either an SQL statement or a callable taking the connection.
+CHAT_MIGRATIONS = [
+    (1, 'messages_chat_id_index', [
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages (chat_id, id)',
+    ]),
+    (2, 'chat_members_indexes', [
+        _dedupe_chat_members,
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_members_chat_user ON chat_members (chat_id, user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_chat_members_user ON chat_members (user_id)',
+    ]),
+    (3, 'analyze', [
+        'ANALYZE',
+    ]),
+    # Nothing was ever counted as unread before (inserts left is_read NULL), so
+    # existing members start with everything read.
+    (4, 'chat_members_read_cursor', [
+        'ALTER TABLE chat_members ADD COLUMN last_read_message_id INTEGER NOT NULL DEFAULT 0',
+        '''UPDATE chat_members SET last_read_message_id = COALESCE(
+               (SELECT MAX(id) FROM messages WHERE messages.chat_id = chat_members.chat_id), 0)''',
+    ]),
+    # Change feed for /sync. Triggers keep it in the same transaction as the write,
+    # whichever code path made it. Existing history is not backfilled: a client
+    # without a sync token bootstraps from /get_chats and /get_messages.
+    (5, 'changes_feed', [
+        '''CREATE TABLE IF NOT EXISTS changes (
+               seq INTEGER PRIMARY KEY AUTOINCREMENT,
+               chat_id INTEGER NOT NULL,
+               user_id INTEGER,
+               kind TEXT NOT NULL,
+               ref_id INTEGER NOT NULL
+           )''',
+        'CREATE INDEX IF NOT EXISTS idx_changes_chat_seq ON changes (chat_id, seq)',
+        '''CREATE TRIGGER IF NOT EXISTS changes_on_message AFTER INSERT ON messages BEGIN
+               INSERT INTO changes (chat_id, user_id, kind, ref_id) VALUES (NEW.chat_id, NULL, 'message', NEW.id);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS changes_on_member AFTER INSERT ON chat_members BEGIN
+               INSERT INTO changes (chat_id, user_id, kind, ref_id) VALUES (NEW.chat_id, NEW.user_id, 'member', NEW.id);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS changes_on_read AFTER UPDATE OF last_read_message_id ON chat_members
+           WHEN NEW.last_read_message_id != OLD.last_read_message_id BEGIN
+               INSERT INTO changes (chat_id, user_id, kind, ref_id)
+               VALUES (NEW.chat_id, NEW.user_id, 'read', NEW.last_read_message_id);
+           END''',
+    ]),
+    # Full-text index; existing rows are indexed by 'python search.py backfill'.
+    (6, 'messages_fts', search.MIGRATION),
+    (7, 'uploads', uploads.MIGRATION),
+    (8, 'upload_thumbnails', thumbnails.MIGRATION),
+    # One row per pair of users with a private chat. If a pair already has
+    # duplicate private chats, the oldest one is kept as the canonical chat.
+    (9, 'direct_chats', [
+        '''CREATE TABLE IF NOT EXISTS direct_chats (
+               user_low INTEGER NOT NULL,
+               user_high INTEGER NOT NULL,
+               chat_id INTEGER NOT NULL,
+               PRIMARY KEY (user_low, user_high)
+           ) WITHOUT ROWID''',
+        '''INSERT OR IGNORE INTO direct_chats (user_low, user_high, chat_id)
+           SELECT user_low, user_high, MIN(chat_id) FROM (
+               SELECT chat_members.chat_id, MIN(chat_members.user_id) AS user_low,
+                      MAX(chat_members.user_id) AS user_high
+               FROM chats JOIN chat_members ON chat_members.chat_id = chats.id
+               WHERE chats.is_private = 1
+               GROUP BY chat_members.chat_id
+               HAVING COUNT(*) = 2
+           )
+           GROUP BY user_low, user_high''',
+    ]),
+    # Last-message summary on each chat, so the chat list needs no messages join.
+    # A trigger keeps it in the insert's transaction. Message ids grow with time,
+    # so last_message_id doubles as the activity sort key (timestamps are
+    # dd/mm/YYYY text and don't sort). Chats without messages keep 0 and sort last.
+    # The chat list reads a member's rows index-only from the covering index
+    # below, then each chat by primary key; sorting a single user's chats needs
+    # no index of its own.
+    (10, 'chat_summaries', [
+        'CREATE INDEX IF NOT EXISTS idx_chat_members_user_chats ON chat_members (user_id, chat_id, last_read_message_id)',
+        'DROP INDEX IF EXISTS idx_chat_members_user',
+        'ALTER TABLE chats ADD COLUMN last_message_id INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE chats ADD COLUMN last_message_at TEXT',
+        'ALTER TABLE chats ADD COLUMN last_message_preview TEXT',
+        'ALTER TABLE chats ADD COLUMN last_sender TEXT',
+        'ALTER TABLE chats ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0',
+        '''UPDATE chats SET
+               last_message_id = COALESCE((SELECT MAX(id) FROM messages WHERE messages.chat_id = chats.id), 0),
+               message_count = (SELECT COUNT(*) FROM messages WHERE messages.chat_id = chats.id)''',
+        '''UPDATE chats SET (last_message_at, last_message_preview, last_sender) = (
+               SELECT timestamp, substr(message, 1, 100), login FROM messages WHERE messages.id = chats.last_message_id)
+           WHERE last_message_id > 0''',
+        '''CREATE TRIGGER IF NOT EXISTS chat_summary_on_message AFTER INSERT ON messages BEGIN
+               UPDATE chats SET
+                   message_count = message_count + 1,
+                   last_message_at = CASE WHEN NEW.id > last_message_id THEN NEW.timestamp ELSE last_message_at END,
+                   last_message_preview = CASE WHEN NEW.id > last_message_id
+                                               THEN substr(NEW.message, 1, 100) ELSE last_message_preview END,
+                   last_sender = CASE WHEN NEW.id > last_message_id THEN NEW.login ELSE last_sender END,
+                   last_message_id = MAX(last_message_id, NEW.id)
+               WHERE id = NEW.chat_id;
+           END''',
+    ]),
+    # Integer epoch-ms times; existing rows are converted in the background
+    # (server start, or 'python timestamps.py backfill').
+    (11, 'epoch_ms_timestamps', timestamps.MIGRATION),
+    # Finished thumbnails change message pages but have no chat_id for the
+    # change feed; this one lets every process drop what it cached for them.
+    (12, 'upload_changes', [
+        '''CREATE TABLE IF NOT EXISTS upload_changes (
+               seq INTEGER PRIMARY KEY AUTOINCREMENT,
+               hash TEXT NOT NULL
+           )''',
+        '''CREATE TRIGGER IF NOT EXISTS upload_changes_on_thumbnails AFTER UPDATE OF thumbnails ON uploads
+           WHEN NEW.thumbnails IS NOT NULL BEGIN
+               INSERT INTO upload_changes (hash) VALUES (NEW.hash);
+           END''',
+    ]),
+    # Migration 11 indexed messages by time but not chats; this covers range
+    # reads of chats by creation time.
+    (13, 'chats_created_index', [
+        'CREATE INDEX IF NOT EXISTS idx_chats_created ON chats (created_ms)',
+    ]),
+]
+
+LOGIN_MIGRATIONS = [
+    (1, 'personal_date_login_unique', [
+        _dedupe_logins,
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_personal_date_login ON personal_date (login)',
+    ]),
+    (2, 'analyze', [
+        'ANALYZE',
+    ]),
+    # Plain-text passwords are hashed with PBKDF2 in the background on server
+    # start ('python auth.py rehash' runs it by hand), or at the user's next login.
+    (3, 'sessions', auth.MIGRATION),
+]
+
+
+def schema_version(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    ''')
+    row = conn.execute('SELECT MAX(version) FROM schema_migrations').fetchone()
+    return row[0] or 0
+
+
+def migrate(path, migrations):
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+    try:
+        applied = []
+        for version, name, steps in migrations:
+            if version <= schema_version(conn):
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Another process may have applied it while we waited for the lock.
+                if version <= schema_version(conn):
+                    conn.execute('ROLLBACK')
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute('INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)',
+                             (version, name, datetime.now().strftime("%d/%m/%Y %H:%M:%S")))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                logging.error(f"Migration {version} ({name}) failed on {path}", exc_info=True)
+                raise
+            logging.info(f"Applied migration {version} ({name}) to {path}")
+            applied.append(version)
+        return applied
+    finally:
+        conn.close()
+
+
+def run_migrations():
+    init_chat_db()
+    init_login_db()
+    for path, migrations in ((CHAT_DB, CHAT_MIGRATIONS), (LOGIN_DB, LOGIN_MIGRATIONS)):
+        migrate(path, migrations)
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA optimize')
+        conn.close()
+
+
+# Every statement server.py issues on the request path. full_scan marks queries that
+# are expected to read the whole table (unfiltered listings).
+HOT_QUERIES = [
+    ('user directory: load / catch up', LOGIN_DB,
+     'SELECT id, login FROM personal_date WHERE id > ? ORDER BY id', (0,), False),
+    ('mark_messages_as_read', CHAT_DB, '''
+        UPDATE chat_members
+        SET last_read_message_id = MAX(last_read_message_id, COALESCE(
+            ?, (SELECT MAX(id) FROM messages WHERE chat_id = ?), 0))
+        WHERE chat_id = ? AND user_id = ?
+     ''', (None, 1, 1, 1), False),
+    ('get_chats / get_user_chats', CHAT_DB, '''
+        SELECT chats.*, chat_members.last_read_message_id,
+               (SELECT COUNT(*) FROM messages
+                WHERE messages.chat_id = chats.id
+                  AND messages.id > chat_members.last_read_message_id
+                  AND messages.login IS NOT ?) AS unread_count
+        FROM chat_members
+        JOIN chats ON chats.id = chat_members.chat_id
+        WHERE chat_members.user_id = ? AND (chats.last_message_id, chats.id) < (?, ?)
+        ORDER BY chats.last_message_id DESC, chats.id DESC
+        LIMIT ?
+     ''', ('x', 1, 2 ** 63 - 1, 2 ** 63 - 1, 51), False),
+    ('membership cache: load', CHAT_DB,
+     'SELECT chat_id FROM chat_members WHERE user_id = ?', (1,), False),
+    ('get_messages: after_id', CHAT_DB,
+     'SELECT * FROM messages WHERE chat_id = ? AND id > ? ORDER BY id LIMIT ?', (1, 0, 51), False),
+    ('get_messages: since / until', CHAT_DB, '''
+        SELECT * FROM messages WHERE chat_id = ? AND (created_ms, id) > (?, ?) AND created_ms < ?
+        ORDER BY created_ms, id LIMIT ?
+     ''', (1, 0, 0, 2 ** 63 - 1, 51), False),
+    ('get_messages: before_id / latest', CHAT_DB,
+     'SELECT * FROM messages WHERE chat_id = ? AND id > ? AND id < ? ORDER BY id DESC LIMIT ?',
+     (1, 0, 100, 51), False),
+    ('send_message: members to notify', CHAT_DB,
+     'SELECT user_id FROM chat_members WHERE chat_id = ?', (1,), False),
+    ('stream: replay', CHAT_DB, '''
+        SELECT messages.* FROM chat_members
+        CROSS JOIN messages ON messages.chat_id = chat_members.chat_id AND messages.id > ?
+        WHERE chat_members.user_id = ?
+        ORDER BY messages.id LIMIT ?
+     ''', (0, 1, 501), False),
+    ('sync', CHAT_DB, '''
+        SELECT changes.* FROM chat_members
+        CROSS JOIN changes ON changes.chat_id = chat_members.chat_id AND changes.seq > ?
+        WHERE chat_members.user_id = ? AND (changes.kind != 'read' OR changes.user_id = ?)
+        ORDER BY changes.seq LIMIT ?
+     ''', (0, 1, 1, 201), False),
+    ('sync: current token', CHAT_DB,
+     "SELECT seq FROM sqlite_sequence WHERE name = 'changes'", (), True),
+    ('version stamps: changes', CHAT_DB,
+     'SELECT seq, chat_id, user_id, kind, ref_id FROM changes WHERE seq > ?', (0,), False),
+    ('version stamps: uploads', CHAT_DB,
+     'SELECT seq, hash FROM upload_changes WHERE seq > ?', (0,), False),
+    ('sync: messages', CHAT_DB,
+     'SELECT * FROM messages WHERE id IN (?, ?)', (1, 2), False),
+    ('sync: chats', CHAT_DB,
+     'SELECT * FROM chats WHERE id IN (?, ?)', (1, 2), False),
+    ('search', CHAT_DB, '''
+        SELECT messages.id, bm25(messages_fts) AS rank
+        FROM messages_fts
+        JOIN messages ON messages.id = messages_fts.rowid
+        WHERE messages_fts MATCH ?
+          AND messages.chat_id IN (SELECT chat_id FROM chat_members WHERE user_id = ?)
+        ORDER BY rank, messages.id LIMIT ?
+     ''', ('"x"', 1, 21), False),
+    ('get_messages: thumbnails', CHAT_DB, '''
+        SELECT hash, thumbnails, placeholder FROM uploads
+        WHERE hash IN (?, ?) AND thumbnails IS NOT NULL
+     ''', ('a', 'b'), False),
+    ('get_personal_date: by login', LOGIN_DB,
+     'SELECT id, login FROM personal_date WHERE login = ?', ('x',), False),
+    ('get_personal_date: all', LOGIN_DB,
+     'SELECT id, login FROM personal_date', (), True),
+    ('add_user_to_chat: chat', CHAT_DB,
+     'SELECT * FROM chats WHERE id = ?', (1,), False),
+    ('add_user_to_chat: existing member', CHAT_DB,
+     'SELECT id FROM chat_members WHERE chat_id = ? AND user_id = ?', (1, 1), False),
+    ('create_private_chat: existing chat', CHAT_DB,
+     'SELECT chat_id FROM direct_chats WHERE user_low = ? AND user_high = ?', (1, 2), False),
+    ('login', LOGIN_DB,
+     'SELECT * FROM personal_date WHERE login = ?', ('x',), False),
+    ('login: purge expired sessions', LOGIN_DB,
+     'DELETE FROM sessions WHERE expires_at <= ?', (0,), False),
+    ('session token: cache miss', LOGIN_DB,
+     'SELECT user_id, login, expires_at FROM sessions WHERE id = ? AND expires_at > ?', ('x', 0), False),
+    ('logout', LOGIN_DB,
+     'DELETE FROM sessions WHERE id = ?', ('x',), False),
+]
+
+
+def check_query_plans(out=sys.stdout):
+    flagged = []
+    connections = {}
+    try:
+        for name, path, sql, params, full_scan in HOT_QUERIES:
+            if path not in connections:
+                connections[path] = sqlite3.connect(path)
+            plan = connections[path].execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+            # FTS5 MATCH shows up as 'SCAN ... VIRTUAL TABLE INDEX', which is an index lookup.
+            scans = [row[3] for row in plan if row[3].startswith('SCAN ') and 'VIRTUAL TABLE INDEX' not in row[3]]
+            bad = bool(scans) and not full_scan
+            print(f"{'SCAN ' if bad else 'ok   '} {name}", file=out)
+            for row in plan:
+                print(f"        {row[3]}", file=out)
+            if bad:
+                flagged.append(name)
+    finally:
+        for conn in connections.values():
+            conn.close()
+    return flagged
+
+
+if __name__ == '__main__':
+    run_migrations()
+    if '--check' in sys.argv:
+        flagged = check_query_plans()
+        if flagged:
+            print(f"{len(flagged)} queries still scan: {', '.join(flagged)}")
+            sys.exit(1)
@@ -0,0 +1,249 @@
+import json
+import threading
+import time
+from collections import OrderedDict, deque
+
+from versions import version_stamps
+
+ENABLED = True
+RECENT_PER_CHAT = 100
+RECENT_MAX_BYTES = 64 * 1024 * 1024
+# Safety net for writes that bypass the change feed (e.g. edits made by hand).
+RECENT_TTL = 30.0
+# Rough per-message cost on top of the JSON text: the str object and deque slot.
+MESSAGE_OVERHEAD = 120
+
+
+class _Chat:
+    __slots__ = ('messages', 'floor', 'bytes', 'uploads', 'loaded_at')
+
+    def __init__(self, floor):
+        # (id, JSON text) of the newest messages, oldest first. Every message of
+        # the chat with an id above floor is in here; floor 0 means all of them.
+        self.messages = deque()
+        self.floor = floor
+        self.bytes = 0
+        self.uploads = set()
+        self.loaded_at = time.monotonic()
+
+
+def _upload_hash(message):
+    # Same test as thumbnails.attach(): content-addressed uploads get thumbnail fields.
+    stem = (message.get('image_url') or '').rsplit('/', 1)[-1].split('.', 1)[0]
+    return stem if len(stem) == 64 else None
+
+
+def _serialize(message):
+    # Matches Flask's jsonify() output for the same dict.
+    return json.dumps(message, sort_keys=True, separators=(',', ':'))
+
+
+class RecentMessages:
+    # Per-chat ring buffer of the newest messages, already serialized as they
+    # appear in /get_messages, with LRU eviction across chats under a byte cap.
+    #
+    # Message writers hold write_lock from insert to append, so appends arrive
+    # in commit order and a ring never has a gap. Messages other processes wrote
+    # arrive through version_stamps' change feed and drop the chat unless its
+    # ring already has them. A load that raced with a write to its chat is
+    # discarded rather than cached.
+    def __init__(self, per_chat=RECENT_PER_CHAT, max_bytes=RECENT_MAX_BYTES, ttl=RECENT_TTL):
+        self.per_chat = per_chat
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.write_lock = threading.Lock()
+        self._chats = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._bypassed = 0
+        self._loads = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    def _drop(self, chat_id):
+        chat = self._chats.pop(chat_id, None)
+        if chat is not None:
+            self._bytes -= chat.bytes
+        if chat_id in self._loading:
+            self._loading[chat_id][1] += 1
+
+    def _push(self, chat, message_id, text, upload):
+        # Returns the change in the chat's size.
+        before = chat.bytes
+        chat.messages.append((message_id, text))
+        chat.bytes += len(text) + MESSAGE_OVERHEAD
+        if upload:
+            chat.uploads.add(upload)
+        while len(chat.messages) > self.per_chat:
+            old_id, old_text = chat.messages.popleft()
+            chat.floor = old_id
+            chat.bytes -= len(old_text) + MESSAGE_OVERHEAD
+        return chat.bytes - before
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._chats:
+            chat_id, chat = self._chats.popitem(last=False)
+            self._bytes -= chat.bytes
+            self._evictions += 1
+
+    def _current(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            return None
+        if time.monotonic() - chat.loaded_at >= self.ttl:
+            self._drop(chat_id)
+            return None
+        return chat
+
+    def add(self, messages):
+        # Write-through after commit, with write_lock held. messages are the
+        # dicts store.insert_message(s) returned.
+        if not ENABLED:
+            return
+        with self._lock:
+            for stored in messages:
+                try:
+                    chat_id = int(stored['chat_id'])
+                except (TypeError, ValueError):
+                    continue
+                chat = self._chats.get(chat_id)
+                if chat_id in self._loading:
+                    self._loading[chat_id][1] += 1
+                if chat is None:
+                    continue
+                if _upload_hash(stored):
+                    # Thumbnail fields come from the uploads table; let a read load it.
+                    self._drop(chat_id)
+                    continue
+                if chat.messages and stored['id'] <= chat.messages[-1][0]:
+                    # Already picked up by a load that ran after the commit.
+                    continue
+                row = {'id': stored['id'], 'chat_id': chat_id, 'message': stored['message'] or '',
+                       'timestamp': stored['timestamp'], 'created_ms': stored['created_ms'],
+                       'login': stored['login'], 'image_url': stored['image_url'], 'is_read': None}
+                self._bytes += self._push(chat, stored['id'], _serialize(row), None)
+            self._evict()
+
+    def _load(self, chat_id, loader):
+        with self._lock:
+            loading = self._loading.setdefault(chat_id, [0, 0])
+            loading[0] += 1
+            generation = loading[1]
+        try:
+            messages = loader(chat_id, self.per_chat + 1)
+        finally:
+            with self._lock:
+                loading = self._loading[chat_id]
+                loading[0] -= 1
+                raced = loading[1] != generation
+                if not loading[0]:
+                    del self._loading[chat_id]
+        floor = 0
+        if len(messages) > self.per_chat:
+            floor = messages[0]['id']
+            messages = messages[1:]
+        chat = _Chat(floor)
+        for message in messages:
+            self._push(chat, message['id'], _serialize(message), _upload_hash(message))
+        with self._lock:
+            self._loads += 1
+            if raced or self._current(chat_id) is not None:
+                return chat
+            self._chats[chat_id] = chat
+            self._bytes += chat.bytes
+            self._evict()
+        return chat
+
+    def page(self, chat_id, after_id, before_id, limit, loader):
+        # Returns (JSON texts, first id, last id, has_more) for a /get_messages
+        # page, or None when the page reaches past the cached messages.
+        # loader(chat_id, count) returns the newest count messages, oldest first.
+        if not ENABLED:
+            return None
+        if after_id is not None and before_id is not None:
+            with self._lock:
+                self._bypassed += 1
+            return None
+        version_stamps.refresh()
+        with self._lock:
+            chat = self._current(chat_id)
+            if chat is not None:
+                self._chats.move_to_end(chat_id)
+                result = self._slice(chat, after_id, before_id, limit)
+                if result is not None:
+                    self._hits += 1
+                    return result
+            self._misses += 1
+        # Scrolling back through history isn't worth a load; the rest mostly fits.
+        if chat is not None or before_id is not None:
+            return None
+        return self._slice(self._load(chat_id, loader), after_id, before_id, limit)
+
+    def _slice(self, chat, after_id, before_id, limit):
+        messages = chat.messages
+        if after_id is not None:
+            if after_id < chat.floor:
+                return None
+            newer = [m for m in messages if m[0] > after_id]
+            page = newer[:limit]
+            has_more = len(newer) > limit
+        else:
+            older = list(messages) if before_id is None else [m for m in messages if m[0] < before_id]
+            if len(older) < limit and chat.floor:
+                return None
+            page = older[-limit:]
+            has_more = len(older) > limit or bool(chat.floor)
+        return ([text for _, text in page], page[0][0] if page else None, page[-1][0] if page else None,
+                has_more)
+
+    def changed(self, messages, uploads):
+        # Change feed listener. None means the feed couldn't be read: drop everything.
+        with self._lock:
+            if messages is None:
+                for chat_id in list(self._chats):
+                    self._drop(chat_id)
+                self._invalidations += 1
+                return
+            for chat_id, message_id in messages:
+                if chat_id in self._loading:
+                    self._loading[chat_id][1] += 1
+                chat = self._chats.get(chat_id)
+                if chat is not None and message_id > chat.floor and all(m[0] != message_id for m in chat.messages):
+                    self._drop(chat_id)
+                    self._invalidations += 1
+            for content_hash in uploads:
+                for chat_id in [chat_id for chat_id, chat in self._chats.items() if content_hash in chat.uploads]:
+                    self._drop(chat_id)
+                    self._invalidations += 1
+
+    def invalidate(self, chat_ids):
+        with self._lock:
+            for chat_id in chat_ids:
+                self._drop(int(chat_id))
+                self._invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'enabled': ENABLED,
+                'chats': len(self._chats),
+                'messages': sum(len(chat.messages) for chat in self._chats.values()),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'per_chat': self.per_chat,
+                'hits': self._hits,
+                'misses': self._misses,
+                'bypassed': self._bypassed,
+                'hit_rate': self._hits / lookups if lookups else 0.0,
+                'loads': self._loads,
+                'evictions': self._evictions,
+                'invalidations': self._invalidations,
+            }
+
+
+recent_messages = RecentMessages()
+version_stamps.subscribe(recent_messages.changed)
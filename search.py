@@ -0,0 +1,121 @@
+import sqlite3
+import sys
+import time
+import logging
+
+from database import CHAT_DB
+
+BACKFILL_CHUNK = 1000
+BACKFILL_PAUSE = 0.05
+
+# messages_fts is an external-content FTS5 table over messages.message. Rows
+# inserted after migration 6 are indexed by trigger; older rows (id <= watermark)
+# are indexed by backfill() in small transactions, tracked in search_backfill.
+# Update/delete triggers only touch rows that are already in the index.
+
+INDEXED = '''(OLD.id > (SELECT watermark FROM search_backfill)
+              OR OLD.id <= (SELECT position FROM search_backfill))'''
+
+MIGRATION = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+           message, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+       )''',
+    'CREATE TABLE IF NOT EXISTS search_backfill (watermark INTEGER NOT NULL, position INTEGER NOT NULL)',
+    '''INSERT INTO search_backfill (watermark, position)
+       SELECT COALESCE((SELECT MAX(id) FROM messages), 0), 0
+       WHERE NOT EXISTS (SELECT 1 FROM search_backfill)''',
+    '''CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+           INSERT INTO messages_fts (rowid, message) VALUES (NEW.id, NEW.message);
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages WHEN {INDEXED} BEGIN
+           INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', OLD.id, OLD.message);
+       END''',
+    f'''CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message ON messages WHEN {INDEXED} BEGIN
+           INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', OLD.id, OLD.message);
+           INSERT INTO messages_fts (rowid, message) VALUES (NEW.id, NEW.message);
+       END''',
+]
+
+
+def match_expression(query):
+    # Every whitespace-separated term is quoted so user input can't inject
+    # FTS5 syntax; terms are ANDed.
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    return ' '.join(terms)
+
+
+def parse_cursor(cursor):
+    rank, message_id = cursor.split(':')
+    return float(rank), int(message_id)
+
+
+def search_messages(conn, user_id, query, chat_id=None, limit=20, after=None):
+    sql = '''
+        SELECT messages.id, messages.chat_id, messages.login, messages.timestamp, messages.created_ms,
+               messages.image_url,
+               snippet(messages_fts, 0, '<mark>', '</mark>', '…', 12) AS snippet,
+               bm25(messages_fts) AS rank
+        FROM messages_fts
+        JOIN messages ON messages.id = messages_fts.rowid
+        WHERE messages_fts MATCH ?
+          AND messages.chat_id IN (SELECT chat_id FROM chat_members WHERE user_id = ?)
+    '''
+    params = [match_expression(query), user_id]
+    if chat_id is not None:
+        sql += ' AND messages.chat_id = ?'
+        params.append(chat_id)
+    if after is not None:
+        rank, message_id = after
+        sql += ' AND (bm25(messages_fts) > ? OR (bm25(messages_fts) = ? AND messages.id > ?))'
+        params.extend([rank, rank, message_id])
+    sql += ' ORDER BY rank, messages.id LIMIT ?'
+    params.append(limit + 1)
+
+    rows = [dict(row) for row in conn.execute(sql, params)]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = f"{rows[-1]['rank']!r}:{rows[-1]['id']}" if has_more else None
+    return rows, next_cursor
+
+
+def backfill(path=CHAT_DB, chunk=BACKFILL_CHUNK, pause=BACKFILL_PAUSE):
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+    try:
+        watermark, position = conn.execute('SELECT watermark, position FROM search_backfill').fetchone()
+        while position < watermark:
+            # Each chunk is its own short IMMEDIATE transaction so writers only
+            # ever wait for one chunk.
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                end = min(position + chunk, watermark)
+                conn.execute('''
+                    INSERT INTO messages_fts (rowid, message)
+                    SELECT id, message FROM messages WHERE id > ? AND id <= ?
+                ''', (position, end))
+                conn.execute('UPDATE search_backfill SET position = ?', (end,))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            position = end
+            logging.info(f"Search backfill at {position}/{watermark}")
+            time.sleep(pause)
+        return position
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='[%(asctime)s | %(levelname)s: %(message)s]',
+                        datefmt='%Y.%m.%d %H:%M:%S', level=logging.INFO)
+    if sys.argv[1:2] == ['backfill']:
+        from migrations import run_migrations
+        run_migrations()
+        backfill()
+    elif sys.argv[1:2] == ['optimize']:
+        conn = sqlite3.connect(CHAT_DB)
+        conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+        conn.commit()
+        conn.close()
+    else:
+        print('usage: python search.py backfill|optimize')
@@ -1,65 +1,153 @@
-from flask import Flask, request, jsonify, render_template_string, send_from_directory
-from datetime import datetime
+from flask import Flask, Response, g, request, jsonify, render_template_string, send_file, url_for
 import sqlite3
-from chat import init_db as init_chat_db
-from login import init_db as init_login_db
+from migrations import run_migrations
+from database import chat_db, login_db, pool_stats
+from events import hub, format_sse, HEARTBEAT_INTERVAL
+import store
+import auth
+import metrics
+from directory import user_directory
+from membership import membership_cache
+from recent import recent_messages
+from versions import version_stamps
+import search
+import uploads
+import thumbnails
+import timestamps
+from writer import write_message, message_writer
 import logging
+import random
+import time
+import uuid
+from logs import setup_logging
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 import os
-import uuid
+import json
+import mimetypes
+import zlib
 from configForServer import UPLOAD_FOLDER
 
-file_log = logging.FileHandler('chat.log')
-console_log = logging.StreamHandler()
-
-logging.basicConfig(handlers=(file_log, console_log), format='[%(asctime)s | %(levelname)s: %(message)s]',
-                    datefmt='%Y.%m.%d %H:%M:%S', level=logging.INFO)
+setup_logging()
 
 app = Flask(__name__)
 
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
-
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['UPLOAD_FOLDER'] = os.path.abspath(UPLOAD_FOLDER)
+app.config['MAX_UPLOAD_SIZE'] = uploads.MAX_UPLOAD_SIZE
+# Lets Werkzeug refuse oversized bodies while reading them; the margin covers multipart framing.
+app.config['MAX_CONTENT_LENGTH'] = app.config['MAX_UPLOAD_SIZE'] + 64 * 1024
+app.config['MESSAGES_PAGE_SIZE'] = 50
+app.config['MESSAGES_MAX_PAGE_SIZE'] = 200
+app.config['STREAM_REPLAY_LIMIT'] = 500
+app.config['MAX_MESSAGE_BATCH'] = 500
+app.config['SYNC_PAGE_SIZE'] = 200
+app.config['SYNC_MAX_PAGE_SIZE'] = 1000
+app.config['SEARCH_PAGE_SIZE'] = 20
+app.config['SEARCH_MAX_PAGE_SIZE'] = 100
+app.config['USERS_MAX_PAGE_SIZE'] = 1000
+app.config['CHATS_MAX_PAGE_SIZE'] = 500
+# Content-addressed uploads never change, so clients and proxies may keep them for a year.
+app.config['UPLOADS_MAX_AGE'] = 365 * 24 * 3600
+# Set to the internal nginx location that aliases UPLOAD_FOLDER (e.g. '/protected-uploads/')
+# to hand file bodies to the proxy with X-Accel-Redirect. Apache/lighttpd can use
+# Flask's own USE_X_SENDFILE instead.
+app.config['UPLOADS_ACCEL_REDIRECT'] = None
+# When off, requests without a session token still act on the ids they send,
+# as before tokens existed. Requests that do carry a token are always checked.
+app.config['REQUIRE_AUTH'] = False
+# Fraction of successful requests that get a request log line; errors and slow
+# requests are always logged. Polled endpoints are sampled by default.
+app.config['REQUEST_LOG_SAMPLE_RATE'] = 1.0
+app.config['REQUEST_LOG_SAMPLE_RATES'] = {
+    'get_messages': 0.1, 'get_chats': 0.1, 'get_user_chats': 0.1, 'sync': 0.1, 'uploaded_file': 0.1,
+}
+app.config['SLOW_REQUEST_MS'] = 500
 
 # logger = logging.getLogger(__name__)
 
-init_chat_db()
-init_login_db()
+run_migrations()
+user_directory.refresh(force=True)
+timestamps.start_backfill()
+auth.start_rehash()
 
 
-def get_db_connection():
-    try:
-        conn = sqlite3.connect('chat.db')
-        conn.row_factory = sqlite3.Row
-        logging.debug("Successfully connected to the database")
-        return conn
-    except Exception as e:
-        logging.error(f"Error connecting to the database: {e}")
-        raise
+if not os.path.exists(UPLOAD_FOLDER):
+    os.makedirs(UPLOAD_FOLDER)
 
 
-def personal_data_db_connection():
-    connect = sqlite3.connect('login.db')
-    connect.row_factory = sqlite3.Row
-    return connect
+def int_arg(name, default=None):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    return int(value)
 
 
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+def not_modified(etag):
+    return Response(status=304, headers={'ETag': f'"{etag}"'})
+
 
+def current_user_id(claimed):
+    return g.user['user_id'] if g.user else claimed
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def current_login(claimed):
+    return g.user['login'] if g.user else claimed
 
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    folder = app.config['UPLOAD_FOLDER']
+    filename = secure_filename(filename)
+    path = uploads.locate(folder, filename)
+    if path is None:
+        return jsonify({'status': 'error', 'message': 'File not found'}), 404
+
+    size = request.args.get('size')
+    if size and thumbnails.enabled():
+        if not size.isdigit() or int(size) not in thumbnails.THUMBNAIL_SIZES:
+            return jsonify({'status': 'error', 'message': 'Unsupported size'}), 400
+        if thumbnails.is_variant(filename):
+            return jsonify({'status': 'error', 'message': 'Thumbnails have no thumbnails'}), 400
+        # Pre-generated variants are served from disk; missing ones are rendered once and cached.
+        # If that fails, the original is still a usable (if larger) answer.
+        try:
+            path = thumbnails.render_on_demand(folder, filename, int(size))
+        except thumbnails.RenderFailed as e:
+            logging.warning(str(e))
+
+    if uploads.content_hash(filename) is None:
+        # Legacy uuid names: Werkzeug's mtime/size ETag and revalidation on every use.
+        return send_file(path, conditional=True)
+    etag = os.path.splitext(os.path.basename(path))[0]
+    if app.config['UPLOADS_ACCEL_REDIRECT']:
+        response = Response(mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        response.set_etag(etag)
+        response.make_conditional(request)
+        if response.status_code == 200:
+            # nginx serves the body, including Range requests, from the internal location.
+            response.headers['X-Accel-Redirect'] = app.config['UPLOADS_ACCEL_REDIRECT'].rstrip('/') + '/' + \
+                os.path.relpath(path, folder).replace(os.sep, '/')
+    else:
+        # send_file answers If-None-Match with 304 and Range with 206 itself.
+        response = send_file(path, etag=etag, conditional=True)
+    response.headers['Cache-Control'] = f"public, max-age={app.config['UPLOADS_MAX_AGE']}, immutable"
+    return response
+
+
+def thumbnail_url(filename, size):
+    return url_for('uploaded_file', filename=filename, size=size, _external=True)
+
+
+def store_thumbnails(filename, variants, placeholder):
+    with chat_db() as conn:
+        thumbnails.save_variants(conn, filename.split('.', 1)[0], variants, placeholder)
+    # The upload_changes feed drops every ETag and the cached pages showing it.
+    version_stamps.refresh(force=True)
 
 
 @app.route('/upload_image', methods=['POST'])
 def upload_image():
-    logging.error(f"Start upload image")
+    logging.debug("Start upload image")
 
     if 'file' not in request.files:
         return jsonify({'status': 'error', 'message': 'No file part'}), 400
@@ -68,15 +156,25 @@ def upload_image():
     if file.filename == '':
         return jsonify({'status': 'error', 'message': 'No selected file'}), 400
 
-    if file and allowed_file(file.filename):
-        unique_filename = str(uuid.uuid4()) + "_" + secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(file_path)
+    try:
+        with chat_db() as conn:
+            filename, duplicate = uploads.save_upload(conn, file.stream, app.config['UPLOAD_FOLDER'],
+                                                      app.config['MAX_UPLOAD_SIZE'])
+    except uploads.UnsupportedType as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except uploads.UploadTooLarge as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 413
+
+    if not duplicate:
+        thumbnails.schedule(app.config['UPLOAD_FOLDER'], filename, store_thumbnails)
 
-        image_url = f"{request.host_url}/uploads/{unique_filename}"
-        return jsonify({'status': 'success', 'image_url': image_url}), 200
+    image_url = url_for('uploaded_file', filename=filename, _external=True)
+    return jsonify({'status': 'success', 'image_url': image_url, 'duplicate': duplicate}), 200
 
-    return jsonify({'status': 'error', 'message': 'File type not allowed'}), 400
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return jsonify({'status': 'error', 'message': 'Upload is too large'}), 413
 
 
 @app.route('/')
@@ -105,26 +203,32 @@ def create_group_chat():
             logging.error("No JSON data received in create_group_chat")
             return jsonify({'status': 'error', 'message': 'No JSON data provided'}), 400
 
-        logging.info(f"Received data: {data}")
+        logging.debug('create_group_chat data: %s', data)
 
         group_name = data.get('name')
-        creator_id = data.get('creator_id')
+        creator_id = current_user_id(data.get('creator_id'))
         user_ids = data.get('user_ids', [])
 
         if not group_name or not creator_id or not isinstance(user_ids, list):
             logging.error(f"Missing required fields. name={group_name}, creator_id={creator_id}, user_ids={user_ids}")
             return jsonify({'status': 'error', 'message': 'Missing or invalid required fields'}), 400
 
-        if creator_id not in user_ids:
-            user_ids.append(creator_id)
+        # Checked before anything is written: the cache and stamp updates after
+        # the commit need integer ids.
+        creator_id = store.parse_id(creator_id)
+        user_ids = [store.parse_id(user_id) for user_id in user_ids]
+        if creator_id is None or None in user_ids:
+            return jsonify({'status': 'error', 'message': 'creator_id and user_ids must be integers'}), 400
 
-        created_at = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-        conn = get_db_connection()
+        user_ids = list(dict.fromkeys(user_ids + [creator_id]))
 
-        try:
+        created_ms = timestamps.now_ms()
+        created_at = timestamps.legacy_text(created_ms)
+
+        with chat_db() as conn:
             cursor = conn.execute(
-                'INSERT INTO chats (name, created_at, is_private, creator_id) VALUES (?, ?, 0, ?)',
-                (group_name, created_at, creator_id)
+                'INSERT INTO chats (name, created_at, created_ms, is_private, creator_id) VALUES (?, ?, ?, 0, ?)',
+                (group_name, created_at, created_ms, creator_id)
             )
             chat_id = cursor.lastrowid
 
@@ -133,23 +237,26 @@ def create_group_chat():
                              (chat_id, str(user_id)))
 
             welcome_message = f"Группа '{group_name}' создана"
-            conn.execute(
-                'INSERT INTO messages (chat_id, message, timestamp, login) VALUES (?, ?, ?, ?)',
-                (chat_id, welcome_message, created_at, 'system')
+            cursor = conn.execute(
+                'INSERT INTO messages (chat_id, message, timestamp, created_ms, login) VALUES (?, ?, ?, ?, ?)',
+                (chat_id, welcome_message, created_at, created_ms, 'system')
             )
+            welcome_id = cursor.lastrowid
 
-            conn.commit()
-            return jsonify({
-                'status': 'success',
-                'chat_id': chat_id,
-                'group_name': group_name,
-                'members': user_ids
-            }), 200
-        except Exception as e:
-            conn.rollback()
-            raise e
-        finally:
-            conn.close()
+        membership_cache.invalidate(user_ids)
+        version_stamps.refresh(force=True)
+        publish_chat({'chat_id': chat_id, 'name': group_name, 'is_private': 0, 'creator_id': creator_id,
+                      'created_at': timestamps.iso(created_ms), 'created_ms': created_ms}, user_ids)
+        publish_message({'id': welcome_id, 'chat_id': chat_id, 'message': welcome_message,
+                         'timestamp': timestamps.iso(created_ms), 'created_ms': created_ms,
+                         'login': 'system', 'image_url': None}, user_ids)
+
+        return jsonify({
+            'status': 'success',
+            'chat_id': chat_id,
+            'group_name': group_name,
+            'members': user_ids
+        }), 200
     except Exception as e:
         logging.error(f"Error creating group chat: {str(e)}", exc_info=True)
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -158,13 +265,24 @@ def create_group_chat():
 @app.route('/get_all_users', methods=['GET'])
 def get_all_users():
     try:
-        conn = personal_data_db_connection()
-        cursor = conn.execute('SELECT id, login FROM personal_date')
-        users = cursor.fetchall()
-        conn.close()
+        limit = int_arg('limit')
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'limit must be an integer'}), 400
+    if limit is not None:
+        limit = max(1, min(limit, app.config['USERS_MAX_PAGE_SIZE']))
+    prefix = request.args.get('prefix', '')
+    after = request.args.get('after') or None
 
-        users_list = [dict(user) for user in users]
-        return jsonify({'users': users_list}), 200
+    try:
+        # The directory only grows, so its version plus the query identifies the page.
+        etag = f"{user_directory.version()}-{zlib.crc32(f'{prefix}|{limit}|{after}'.encode('utf-8')):08x}"
+        if etag in request.if_none_match:
+            return not_modified(etag)
+
+        users_list, next_cursor = user_directory.page(prefix, limit, after)
+        response = jsonify({'users': users_list, 'next_cursor': next_cursor})
+        response.set_etag(etag)
+        return response, 200
     except Exception as e:
         logging.error(f"Error fetching users: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -177,13 +295,10 @@ def get_user_id():
         return jsonify({'status': 'error', 'message': 'No login provided'}), 400
 
     try:
-        conn = personal_data_db_connection()
-        cursor = conn.execute('SELECT id FROM personal_date WHERE login = ?', (login,))
-        user = cursor.fetchone()
-        conn.close()
+        user_id = user_directory.get_id(login)
 
-        if user:
-            return jsonify({'status': 'success', 'user_id': user['id']}), 200
+        if user_id is not None:
+            return jsonify({'status': 'success', 'user_id': user_id}), 200
         else:
             return jsonify({'status': 'error', 'message': 'User not found'}), 404
     except Exception as e:
@@ -194,47 +309,40 @@ def get_user_id():
 @app.route('/create_chat', methods=['POST'])
 def create_chat():
     try:
-        logging.info(f"Headers: {request.headers}")
-        logging.info(f"Content-Type: {request.content_type}")
-
         if request.is_json:
             data = request.get_json()
-            logging.info(f"JSON data received: {data}")
             chat_name = data.get('name')
         else:
+            data = request.form
             chat_name = request.form.get('name')
-            logging.info(f"Form data received: {request.form}")
+        logging.debug('create_chat content_type=%s data=%s', request.content_type, data)
 
         if not chat_name:
             logging.error("No chat name provided in create_chat request")
             return jsonify({'status': 'error', 'message': 'No chat name provided'}), 400
 
-        created_at = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-        conn = get_db_connection()
+        created_ms = timestamps.now_ms()
+        created_at = timestamps.legacy_text(created_ms)
 
         try:
-            logging.info(f"Attempting to create chat: {chat_name}")
-            cursor = conn.execute('INSERT INTO chats (name, created_at) VALUES (?, ?)',
-                                  (chat_name, created_at))
-            chat_id = cursor.lastrowid
+            with chat_db() as conn:
+                cursor = conn.execute('INSERT INTO chats (name, created_at, created_ms) VALUES (?, ?, ?)',
+                                      (chat_name, created_at, created_ms))
+                chat_id = cursor.lastrowid
 
-            welcome_message = "Это новый чат"
-            conn.execute('INSERT INTO messages (chat_id, message, timestamp, login) VALUES (?, ?, ?, ?)',
-                         (chat_id, welcome_message, created_at, 'system'))
+                welcome_message = "Это новый чат"
+                conn.execute('INSERT INTO messages (chat_id, message, timestamp, created_ms, login) VALUES (?, ?, ?, ?, ?)',
+                             (chat_id, welcome_message, created_at, created_ms, 'system'))
+            version_stamps.refresh(force=True)
 
-            conn.commit()
-            logging.info(f"Successfully created chat {chat_id}: {chat_name}")
+            logging.info('Created chat %s: %s', chat_id, chat_name)
             return jsonify({'status': 'success', 'message': 'Chat created', 'chat_id': chat_id}), 200
         except sqlite3.Error as e:
-            conn.rollback()
             logging.error(f"Database error creating chat {chat_name}: {str(e)}")
             return jsonify({'status': 'error', 'message': 'Database error'}), 500
         except Exception as e:
-            conn.rollback()
             logging.error(f"Unexpected error creating chat {chat_name}: {str(e)}", exc_info=True)
             return jsonify({'status': 'error', 'message': 'Unexpected error'}), 500
-        finally:
-            conn.close()
     except Exception as e:
         logging.error(f"Error in create_chat endpoint: {str(e)}", exc_info=True)
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -246,49 +354,101 @@ def mark_messages_as_read():
         if request.is_json:
             data = request.json
             chat_id = data.get('chat_id')
-            user_id = data.get('user_id')
+            user_id = current_user_id(data.get('user_id'))
         else:
             chat_id = request.form.get('chat_id')
-            user_id = request.form.get('user_id')
+            user_id = current_user_id(request.form.get('user_id'))
 
-        if chat_id:
-            conn = get_db_connection()
-            conn.execute('UPDATE messages SET is_read = 1 WHERE chat_id = ?', (chat_id,))
-            conn.commit()
-            conn.close()
+        message_id = data.get('message_id') if request.is_json else request.form.get('message_id')
+        if message_id not in (None, ''):
+            message_id = store.parse_id(message_id)
+            if message_id is None:
+                return jsonify({'status': 'error', 'message': 'message_id must be an integer'}), 400
+        else:
+            message_id = None
+
+        if chat_id and user_id:
+            with chat_db() as conn:
+                updated = store.mark_read(conn, chat_id, user_id, message_id)
+            if not updated:
+                return jsonify({'status': 'error', 'message': 'Access denied'}), 403
+            version_stamps.refresh(force=True)
             return jsonify({'status': 'success', 'message': 'Messages marked as read'}), 200
         else:
-            return jsonify({'status': 'error', 'message': 'No chat_id provided'}), 400
+            return jsonify({'status': 'error', 'message': 'No chat_id or user_id provided'}), 400
     except Exception as e:
         logging.error(f"Error marking messages as read: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
+def fetch_user_chats(user_id, limit=None, before=None):
+    login = user_directory.get_login(user_id)
+
+    # Most recently active first, from the summary columns the message trigger
+    # maintains. unread_count is a range count past the member's read cursor on
+    # the (chat_id, id) index, so the cost follows unread volume, not history.
+    # `before` is the (last_message_id, id) of the previous page's last chat.
+    query = '''
+        SELECT chats.*, chat_members.last_read_message_id,
+               (SELECT COUNT(*) FROM messages
+                WHERE messages.chat_id = chats.id
+                  AND messages.id > chat_members.last_read_message_id
+                  AND messages.login IS NOT ?) AS unread_count
+        FROM chat_members
+        JOIN chats ON chats.id = chat_members.chat_id
+        WHERE chat_members.user_id = ? AND (chats.last_message_id, chats.id) < (?, ?)
+        ORDER BY chats.last_message_id DESC, chats.id DESC
+        LIMIT ?
+    '''
+    last_message_id, chat_id = before or (2 ** 63 - 1, 2 ** 63 - 1)
+    with chat_db() as conn:
+        chats = conn.execute(query, (login, user_id, last_message_id, chat_id,
+                                     -1 if limit is None else limit + 1)).fetchall()
+
+    chats = [timestamps.chat_out(dict(chat)) for chat in chats]
+    next_cursor = None
+    if limit is not None and len(chats) > limit:
+        chats = chats[:limit]
+        next_cursor = f"{chats[-1]['last_message_id']}.{chats[-1]['id']}"
+    return chats, next_cursor
+
+
+def user_chats_response(user_id):
+    # Without limit the whole list comes back, as it did before paging existed.
+    try:
+        limit = int_arg('limit')
+        before = request.args.get('before') or None
+        if before is not None:
+            before = tuple(int(part) for part in before.split('.', 1))
+            if len(before) != 2:
+                raise ValueError(before)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'limit and before must be a number and a cursor'}), 400
+    if limit is not None:
+        limit = max(1, min(limit, app.config['CHATS_MAX_PAGE_SIZE']))
+
+    # The ETag comes from version stamps and the membership cache, so an
+    # unchanged list is answered without running the query. It is taken before
+    # the query: a write landing in between makes the next poll refetch.
+    etag = version_stamps.chats_etag(user_id, membership_cache.chat_ids(user_id), limit, before)
+    if etag in request.if_none_match:
+        return not_modified(etag)
+    chats, next_cursor = fetch_user_chats(user_id, limit, before)
+    response = jsonify({'chats': chats, 'next_cursor': next_cursor})
+    response.set_etag(etag)
+    return response
+
+
 @app.route('/get_chats', methods=['GET'])
 def get_chats():
-    user_id = request.args.get('user_id')
-    if not user_id:
+    user_id = current_user_id(request.args.get('user_id'))
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
         return jsonify({'status': 'error', 'message': 'No user_id provided'}), 400
 
     try:
-        conn = get_db_connection()
-
-        query = '''
-            SELECT chats.*, 
-                   COUNT(CASE WHEN messages.is_read = 0 AND messages.login != ? THEN 1 END) AS unread_count
-            FROM chats
-            JOIN chat_members ON chats.id = chat_members.chat_id
-            LEFT JOIN messages ON chats.id = messages.chat_id
-            WHERE chat_members.user_id = ?
-            GROUP BY chats.id
-        '''
-        cursor = conn.execute(query, (user_id, user_id))
-        chats = cursor.fetchall()
-
-        conn.close()
-
-        chats_list = [dict(chat) for chat in chats]
-        return jsonify({'chats': chats_list}), 200
+        return user_chats_response(user_id)
     except Exception as e:
         logging.error(f"Error fetching chats: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -300,60 +460,309 @@ def send_message():
         data = request.json
         message = data.get('message')
         chat_id = data.get('chat_id')
-        login = data.get('login')
+        login = current_login(data.get('login'))
         image_url = data.get('image_url')
     else:
         message = request.form.get('message')
         chat_id = request.form.get('chat_id')
-        login = request.form.get('login')
+        login = current_login(request.form.get('login'))
         image_url = request.form.get('image_url')
 
     if (message or image_url) and chat_id and login:
-        timestamp = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-        conn = get_db_connection()
-        conn.execute('''
-            INSERT INTO messages (chat_id, message, timestamp, login, image_url)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (chat_id, message, timestamp, login, image_url))
-        conn.commit()
-        conn.close()
-        return jsonify({'status': 'success', 'message': 'Message received'}), 200
+        chat_id = store.parse_id(chat_id)
+        if chat_id is None:
+            return jsonify({'status': 'error', 'message': 'Invalid chat_id'}), 400
+        try:
+            stored = write_message(chat_id, message, login, image_url)
+        except Exception as e:
+            logging.error(f"Error storing message: {e}")
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+        publish_message(stored)
+        return jsonify({'status': 'success', 'message': 'Message received', 'message_id': stored['id']}), 200
     else:
         return jsonify({'status': 'error', 'message': 'No message, chat_id, or login provided'}), 400
 
 
+@app.route('/send_messages', methods=['POST'])
+def send_messages():
+    data = request.get_json(silent=True)
+    items = data.get('messages') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return jsonify({'status': 'error', 'message': 'Expected a non-empty array of messages'}), 400
+    if len(items) > app.config['MAX_MESSAGE_BATCH']:
+        return jsonify({'status': 'error',
+                        'message': f"At most {app.config['MAX_MESSAGE_BATCH']} messages per batch"}), 413
+
+    # Invalid entries are reported individually; the valid ones still go in.
+    results = [None] * len(items)
+    rows = []
+    positions = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = {'index': index, 'status': 'error', 'message': 'Entry must be an object'}
+            continue
+        message = item.get('message')
+        chat_id = item.get('chat_id')
+        login = item.get('login')
+        image_url = item.get('image_url')
+        if g.user and login not in (None, '', g.user['login']):
+            results[index] = {'index': index, 'status': 'error', 'message': 'Access denied'}
+            continue
+        login = current_login(login)
+        if not ((message or image_url) and chat_id and login):
+            results[index] = {'index': index, 'status': 'error',
+                              'message': 'No message, chat_id, or login provided'}
+            continue
+        chat_id = store.parse_id(chat_id)
+        if chat_id is None:
+            results[index] = {'index': index, 'status': 'error', 'message': 'Invalid chat_id'}
+            continue
+        rows.append((chat_id, message, login, image_url))
+        positions.append(index)
+
+    stored = []
+    if rows:
+        try:
+            with recent_messages.write_lock:
+                with chat_db() as conn:
+                    stored = store.insert_messages(conn, rows)
+                recent_messages.add(stored)
+        except Exception as e:
+            logging.error(f"Error storing message batch: {e}")
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+
+    version_stamps.refresh(force=True)
+    for index, message in zip(positions, stored):
+        results[index] = {'index': index, 'status': 'success', 'message_id': message['id']}
+
+    members = {}
+    for message in stored:
+        if not hub.has_subscribers():
+            break
+        if message['chat_id'] not in members:
+            with chat_db() as conn:
+                members[message['chat_id']] = store.chat_member_ids(conn, message['chat_id'])
+        publish_message(message, members[message['chat_id']])
+
+    return jsonify({
+        'status': 'success' if len(stored) == len(items) else 'partial',
+        'results': results
+    }), 200
+
+
+def load_recent_messages(chat_id, count):
+    with chat_db() as conn:
+        messages = conn.execute(
+            'SELECT * FROM messages WHERE chat_id = ? AND id > ? AND id < ? ORDER BY id DESC LIMIT ?',
+            (chat_id, 0, 2 ** 63 - 1, count)
+        ).fetchall()
+        return thumbnails.attach(conn, [timestamps.message_out(dict(msg)) for msg in messages[::-1]], thumbnail_url)
+
+
+def cached_messages_response(page, after_id, before_id, etag):
+    # The same body get_messages() builds, assembled from cached JSON text.
+    texts, first_id, last_id, has_more = page
+    forward = after_id is not None and before_id is None
+    body = '{"has_more":%s,"messages":[%s],"next_cursor":%s,"prev_cursor":%s}' % (
+        json.dumps(has_more), ','.join(texts), json.dumps(last_id if texts else after_id),
+        json.dumps(first_id if texts and (forward or has_more) else None))
+    response = Response(body + '\n', mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+
 @app.route('/get_messages', methods=['GET'])
 def get_messages():
     chat_id = request.args.get('chat_id')
-    user_id = request.args.get('user_id')
+    user_id = current_user_id(request.args.get('user_id'))
 
     if not chat_id or not user_id:
         return jsonify({'status': 'error', 'message': 'No chat_id or user_id provided'}), 400
 
     try:
-        conn = get_db_connection()
+        chat_id, user_id = int(chat_id), int(user_id)
+        after_id = int_arg('after_id')
+        before_id = int_arg('before_id')
+        limit = int_arg('limit', app.config['MESSAGES_PAGE_SIZE'])
+        since = request.args.get('since') or None
+        until = request.args.get('until') or None
+        since = timestamps.parse_time(since) if since is not None else None
+        until = timestamps.parse_time(until) if until is not None else None
+        cursor = request.args.get('cursor') or None
+        if cursor is not None:
+            cursor_ms, cursor_id = (int(part) for part in cursor.rsplit('.', 1))
+    except ValueError:
+        return jsonify({'status': 'error',
+                        'message': 'chat_id, user_id, after_id, before_id and limit must be integers, '
+                                   'since and until epoch milliseconds or ISO-8601, '
+                                   'cursor a next_cursor from a time range page'}), 400
+    limit = max(1, min(limit, app.config['MESSAGES_MAX_PAGE_SIZE']))
 
-        member = conn.execute(
-            'SELECT 1 FROM chat_members WHERE chat_id = ? AND user_id = ?',
-            (chat_id, user_id)
-        ).fetchone()
-
-        if not member:
-            conn.close()
+    try:
+        if not membership_cache.is_member(chat_id, user_id):
             return jsonify({'status': 'error', 'message': 'Access denied'}), 403
+        etag = version_stamps.chat_etag(chat_id, after_id, before_id, limit, since, until, cursor)
+        if etag in request.if_none_match:
+            return not_modified(etag)
+
+        ranged = since is not None or until is not None or cursor is not None
+        if not ranged:
+            page = recent_messages.page(chat_id, after_id, before_id, limit, load_recent_messages)
+            if page is not None:
+                return cached_messages_response(page, after_id, before_id, etag)
+
+        with chat_db() as conn:
+            # Keyset pagination on messages.id, served by the (chat_id, id) index.
+            # after_id alone pages forward (polling); otherwise we page backwards from
+            # before_id or from the newest message. A since/until time range is
+            # read oldest first on the (chat_id, created_ms) index and paged with
+            # a "<created_ms>.<id>" cursor; after_id only breaks ties inside the
+            # since millisecond. Rows the timestamp backfill hasn't reached yet
+            # are not in any range.
+            forward = after_id is not None and before_id is None
+            if ranged:
+                start = (since if since is not None else -2 ** 63, after_id or 0)
+                if cursor is not None:
+                    start = max(start, (cursor_ms, cursor_id))
+                messages = conn.execute('''
+                    SELECT * FROM messages WHERE chat_id = ? AND (created_ms, id) > (?, ?) AND created_ms < ?
+                    ORDER BY created_ms, id LIMIT ?
+                ''', (chat_id, *start, until if until is not None else 2 ** 63 - 1, limit + 1)).fetchall()
+                has_more = len(messages) > limit
+                messages = messages[:limit]
+                forward = True
+            elif forward:
+                messages = conn.execute(
+                    'SELECT * FROM messages WHERE chat_id = ? AND id > ? ORDER BY id LIMIT ?',
+                    (chat_id, after_id, limit + 1)
+                ).fetchall()
+                has_more = len(messages) > limit
+                messages = messages[:limit]
+            else:
+                messages = conn.execute(
+                    'SELECT * FROM messages WHERE chat_id = ? AND id > ? AND id < ? ORDER BY id DESC LIMIT ?',
+                    (chat_id, after_id or 0, before_id if before_id is not None else 2 ** 63 - 1, limit + 1)
+                ).fetchall()
+                has_more = len(messages) > limit
+                messages = messages[:limit][::-1]
+
+            messages_list = thumbnails.attach(conn, [timestamps.message_out(dict(msg)) for msg in messages],
+                                              thumbnail_url)
+        if ranged:
+            next_cursor = f"{messages_list[-1]['created_ms']}.{messages_list[-1]['id']}" if messages_list else cursor
+            prev_cursor = None
+        else:
+            next_cursor = messages_list[-1]['id'] if messages_list else after_id
+            prev_cursor = messages_list[0]['id'] if messages_list and (forward or has_more) else None
+        response = jsonify({
+            'messages': messages_list,
+            'next_cursor': next_cursor,
+            'prev_cursor': prev_cursor,
+            'has_more': has_more
+        })
+        response.set_etag(etag)
+        return response, 200
 
-        messages = conn.execute(
-            'SELECT * FROM messages WHERE chat_id = ? ORDER BY timestamp',
-            (chat_id,)
-        ).fetchall()
+    except Exception as e:
+        logging.error(f"Error fetching messages: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
 
-        conn.close()
 
-        messages_list = [dict(msg) for msg in messages]
-        return jsonify({'messages': messages_list}), 200
+@app.route('/sync', methods=['GET'])
+def sync():
+    user_id = current_user_id(request.args.get('user_id'))
+    if not user_id:
+        return jsonify({'status': 'error', 'message': 'No user_id provided'}), 400
 
+    try:
+        since = int_arg('since')
+        limit = int_arg('limit', app.config['SYNC_PAGE_SIZE'])
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'since and limit must be integers'}), 400
+    limit = max(1, min(limit, app.config['SYNC_MAX_PAGE_SIZE']))
+
+    try:
+        with chat_db() as conn:
+            if since is None:
+                # No token yet: hand out the current position; the client loads
+                # its initial state from /get_chats and /get_messages.
+                row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+                return jsonify({'changes': [], 'sync_token': row['seq'] if row else 0,
+                                'has_more': False, 'reset': True}), 200
+
+            # CROSS JOIN pins the join order so this is one (chat_id, seq) range
+            # seek per chat of the user, not a walk over everyone's changes.
+            rows = conn.execute('''
+                SELECT changes.* FROM chat_members
+                CROSS JOIN changes ON changes.chat_id = chat_members.chat_id AND changes.seq > ?
+                WHERE chat_members.user_id = ? AND (changes.kind != 'read' OR changes.user_id = ?)
+                ORDER BY changes.seq LIMIT ?
+            ''', (since, user_id, user_id, limit + 1)).fetchall()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+
+            message_ids = [row['ref_id'] for row in rows if row['kind'] == 'message']
+            chat_ids = list({row['chat_id'] for row in rows if row['kind'] == 'member'})
+            messages = {}
+            chats = {}
+            if message_ids:
+                placeholders = ', '.join('?' * len(message_ids))
+                messages = {row['id']: timestamps.message_out(dict(row)) for row in conn.execute(
+                    f'SELECT * FROM messages WHERE id IN ({placeholders})', message_ids)}
+                thumbnails.attach(conn, list(messages.values()), thumbnail_url)
+            if chat_ids:
+                placeholders = ', '.join('?' * len(chat_ids))
+                chats = {row['id']: timestamps.chat_out(dict(row)) for row in conn.execute(
+                    f'SELECT * FROM chats WHERE id IN ({placeholders})', chat_ids)}
+
+        changes = []
+        for row in rows:
+            change = {'seq': row['seq'], 'kind': row['kind'], 'chat_id': row['chat_id']}
+            if row['kind'] == 'message':
+                change['message'] = messages.get(row['ref_id'])
+            elif row['kind'] == 'member':
+                change['user_id'] = row['user_id']
+                change['chat'] = chats.get(row['chat_id'])
+            elif row['kind'] == 'read':
+                change['user_id'] = row['user_id']
+                change['last_read_message_id'] = row['ref_id']
+            changes.append(change)
+
+        return jsonify({
+            'changes': changes,
+            'sync_token': rows[-1]['seq'] if rows else since,
+            'has_more': has_more
+        }), 200
     except Exception as e:
-        logging.error(f"Error fetching messages: {e}")
+        logging.error(f"Error syncing user {user_id}: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+@app.route('/search', methods=['GET'])
+def search_messages():
+    user_id = current_user_id(request.args.get('user_id'))
+    query = request.args.get('q', '').strip()
+    if not user_id or not query:
+        return jsonify({'status': 'error', 'message': 'No user_id or q provided'}), 400
+
+    try:
+        user_id = int(user_id)
+        chat_id = int_arg('chat_id')
+        limit = int_arg('limit', app.config['SEARCH_PAGE_SIZE'])
+        after = request.args.get('after')
+        after = search.parse_cursor(after) if after else None
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid user_id, chat_id, limit or after'}), 400
+    limit = max(1, min(limit, app.config['SEARCH_MAX_PAGE_SIZE']))
+
+    try:
+        if chat_id is not None and not membership_cache.is_member(chat_id, user_id):
+            return jsonify({'status': 'error', 'message': 'Access denied'}), 403
+        with chat_db() as conn:
+            results, next_cursor = search.search_messages(conn, user_id, query, chat_id, limit, after)
+        return jsonify({'results': [timestamps.message_out(result) for result in results], 'next_cursor': next_cursor}), 200
+    except Exception as e:
+        logging.error(f"Error searching messages: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
@@ -369,29 +778,32 @@ def set_date():
             password = request.form.get('password')
 
         if login and password:
-            connect = personal_data_db_connection()
-            connect.execute('INSERT INTO personal_date (login, password) VALUES (?, ?)',
-                            (login, password))
-            connect.commit()
-            connect.close()
+            password_hash = auth.hash_password(password)
+            with login_db() as connect:
+                cursor = connect.execute('INSERT INTO personal_date (login, password) VALUES (?, ?)',
+                                         (login, password_hash))
+            user_directory.add(cursor.lastrowid, login)
             return jsonify({'status': 'success'}), 200
         else:
             return jsonify({'status': 'error'}), 400
+    except auth.HashingBusy:
+        return jsonify({'status': 'error', 'message': 'Too many sign-ups in progress, try again'}), 503
+    except sqlite3.IntegrityError:
+        return jsonify({'status': 'error', 'message': 'Login already taken'}), 409
     except Exception as e:
         logging.error(e)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
 @app.route('/get_personal_date', methods=['GET'])
 def get_date():
     loginN = request.args.get('login')
-    connect = personal_data_db_connection()
-
-    if loginN:
-        data = connect.execute('SELECT * FROM personal_date WHERE login = ?', (loginN,)).fetchall()
-    else:
-        data = connect.execute('SELECT * FROM personal_date').fetchall()
-
-    connect.close()
+    # Never the password column: it holds the password hashes.
+    with login_db() as connect:
+        if loginN:
+            data = connect.execute('SELECT id, login FROM personal_date WHERE login = ?', (loginN,)).fetchall()
+        else:
+            data = connect.execute('SELECT id, login FROM personal_date').fetchall()
 
     data_list = [dict(row) for row in data]
     return jsonify({'data': data_list}), 200
@@ -399,26 +811,14 @@ def get_date():
 
 @app.route('/get_user_chats', methods=['GET'])
 def get_user_chats():
-    user_id = request.args.get('user_id')
-    if not user_id:
+    user_id = current_user_id(request.args.get('user_id'))
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
         return jsonify({'status': 'error', 'message': 'No user_id provided'}), 400
 
     try:
-        conn = get_db_connection()
-        query = '''
-            SELECT chats.*, COUNT(CASE WHEN messages.is_read = 0 AND messages.login != ? THEN 1 END) AS unread_count
-            FROM chats
-            JOIN chat_members ON chats.id = chat_members.chat_id
-            LEFT JOIN messages ON chats.id = messages.chat_id
-            WHERE chat_members.user_id = ?
-            GROUP BY chats.id
-        '''
-        cursor = conn.execute(query, (user_id, user_id))
-        chats = cursor.fetchall()
-        conn.close()
-
-        chats_list = [dict(chat) for chat in chats]
-        return jsonify({'chats': chats_list}), 200
+        return user_chats_response(user_id)
     except Exception as e:
         logging.error(f"Error fetching user chats: {e}")
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -430,28 +830,39 @@ def add_user_to_chat():
         data = request.json
         chat_id = data.get('chat_id')
         user_id = data.get('user_id')
-        adder_id = data.get('adder_id')
+        adder_id = current_user_id(data.get('adder_id'))
 
         if not all([chat_id, user_id, adder_id]):
             return jsonify({'status': 'error', 'message': 'Missing required fields'}), 400
-
-        conn = get_db_connection()
-
-        cursor = conn.execute('SELECT creator_id FROM chats WHERE id = ?', (chat_id,))
-        chat = cursor.fetchone()
-
-        if not chat or chat['creator_id'] != adder_id:
-            conn.close()
-            return jsonify({'status': 'error', 'message': 'Not authorized to add users to this chat'}), 403
-
-        cursor = conn.execute('SELECT id FROM chat_members WHERE chat_id = ? AND user_id = ?', (chat_id, user_id))
-        if cursor.fetchone():
-            conn.close()
-            return jsonify({'status': 'error', 'message': 'User is already in the chat'}), 400
-
-        conn.execute('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)', (chat_id, user_id))
-        conn.commit()
-        conn.close()
+        chat_id, user_id, adder_id = (store.parse_id(value) for value in (chat_id, user_id, adder_id))
+        if None in (chat_id, user_id, adder_id):
+            return jsonify({'status': 'error', 'message': 'chat_id, user_id and adder_id must be integers'}), 400
+
+        with chat_db() as conn:
+            cursor = conn.execute('SELECT * FROM chats WHERE id = ?', (chat_id,))
+            chat = cursor.fetchone()
+
+            if not chat or chat['creator_id'] != adder_id:
+                return jsonify({'status': 'error', 'message': 'Not authorized to add users to this chat'}), 403
+
+            cursor = conn.execute('SELECT id FROM chat_members WHERE chat_id = ? AND user_id = ?', (chat_id, user_id))
+            if cursor.fetchone():
+                return jsonify({'status': 'error', 'message': 'User is already in the chat'}), 400
+
+            conn.execute('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)', (chat_id, user_id))
+            members = []
+            if hub.has_subscribers():
+                members = store.chat_member_ids(conn, chat_id)
+
+        membership_cache.invalidate([user_id])
+        version_stamps.refresh(force=True)
+        if members:
+            summary = timestamps.chat_out({'created_at': chat['created_at'], 'created_ms': chat['created_ms']})
+            publish_chat({'chat_id': chat['id'], 'name': chat['name'], 'is_private': chat['is_private'],
+                          'creator_id': chat['creator_id'], **summary},
+                         members, targets=[user_id])
+            hub.publish([m for m in members if str(m) != str(user_id)],
+                        {'event': 'member', 'data': {'chat_id': chat['id'], 'user_id': user_id}})
 
         return jsonify({'status': 'success', 'message': 'User added to chat'}), 200
     except Exception as e:
@@ -463,18 +874,13 @@ def add_user_to_chat():
 def create_private_chat():
     try:
         data = request.get_json()
-        logging.info(f"Received data for private chat: {data}")
+        logging.debug('create_private_chat data: %s', data)
 
-        user1_id = str(data.get('user1_id'))
+        user1_id = str(current_user_id(data.get('user1_id')))
         user2_id = str(data.get('user2_id'))
-        logging.info(f"User IDs received: {user1_id} (user1), {user2_id} (user2)")
 
-        login_conn = personal_data_db_connection()
-        all_users = login_conn.execute('SELECT id, login FROM personal_date').fetchall()
-        logging.info(f"All users in DB: {[dict(u) for u in all_users]}")
-        user1_exists = login_conn.execute('SELECT 1 FROM personal_date WHERE id = ?', (user1_id,)).fetchone()
-        user2_exists = login_conn.execute('SELECT 1 FROM personal_date WHERE id = ?', (user2_id,)).fetchone()
-        login_conn.close()
+        user1_exists = user_directory.exists(user1_id)
+        user2_exists = user_directory.exists(user2_id)
 
         if not user1_exists or not user2_exists:
             return jsonify({
@@ -484,41 +890,51 @@ def create_private_chat():
                 'user2_exists': bool(user2_exists)
             }), 404
 
-        chat_conn = get_db_connection()
-        existing_chat = chat_conn.execute('''
-            SELECT c.id FROM chats c
-            JOIN chat_members cm1 ON c.id = cm1.chat_id AND cm1.user_id = ?
-            JOIN chat_members cm2 ON c.id = cm2.chat_id AND cm2.user_id = ?
-            WHERE c.is_private = 1
-        ''', (user1_id, user2_id)).fetchone()
-
-        if existing_chat:
-            chat_conn.close()
-            return jsonify({
-                'status': 'success',
-                'chat_id': existing_chat['id'],
-                'message': 'Chat already exists'
-            }), 200
-
-        created_at = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
-        chat_name = f"Private chat {user1_id}-{user2_id}"
-
-        cursor = chat_conn.execute(
-            'INSERT INTO chats (name, created_at, is_private, creator_id) VALUES (?, ?, 1, ?)',
-            (chat_name, created_at, user1_id)
-        )
-        chat_id = cursor.lastrowid
+        if user1_id == user2_id:
+            return jsonify({'status': 'error', 'message': 'Cannot create a private chat with yourself'}), 400
+
+        with chat_db() as chat_conn:
+            existing_chat_id = store.direct_chat_id(chat_conn, user1_id, user2_id)
+            if existing_chat_id is None:
+                # Re-check under the write lock so two concurrent requests for the
+                # same pair can't both see "no chat" and create one each.
+                chat_conn.execute('BEGIN IMMEDIATE')
+                existing_chat_id = store.direct_chat_id(chat_conn, user1_id, user2_id)
+
+            if existing_chat_id is not None:
+                return jsonify({
+                    'status': 'success',
+                    'chat_id': existing_chat_id,
+                    'message': 'Chat already exists'
+                }), 200
+
+            created_ms = timestamps.now_ms()
+            created_at = timestamps.legacy_text(created_ms)
+            chat_name = f"Private chat {user1_id}-{user2_id}"
+
+            cursor = chat_conn.execute(
+                'INSERT INTO chats (name, created_at, created_ms, is_private, creator_id) VALUES (?, ?, ?, 1, ?)',
+                (chat_name, created_at, created_ms, user1_id)
+            )
+            chat_id = cursor.lastrowid
+            store.add_direct_chat(chat_conn, user1_id, user2_id, chat_id)
 
-        chat_conn.execute('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)', (chat_id, user1_id))
-        chat_conn.execute('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)', (chat_id, user2_id))
+            chat_conn.execute('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)', (chat_id, user1_id))
+            chat_conn.execute('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)', (chat_id, user2_id))
 
-        chat_conn.execute(
-            'INSERT INTO messages (chat_id, message, timestamp, login) VALUES (?, ?, ?, ?)',
-            (chat_id, f"Приватный чат создан", created_at, 'system')
-        )
+            cursor = chat_conn.execute(
+                'INSERT INTO messages (chat_id, message, timestamp, created_ms, login) VALUES (?, ?, ?, ?, ?)',
+                (chat_id, f"Приватный чат создан", created_at, created_ms, 'system')
+            )
+            welcome_id = cursor.lastrowid
 
-        chat_conn.commit()
-        chat_conn.close()
+        membership_cache.invalidate([user1_id, user2_id])
+        version_stamps.refresh(force=True)
+        publish_chat({'chat_id': chat_id, 'name': chat_name, 'is_private': 1, 'creator_id': user1_id,
+                      'created_at': timestamps.iso(created_ms), 'created_ms': created_ms}, [user1_id, user2_id])
+        publish_message({'id': welcome_id, 'chat_id': chat_id, 'message': "Приватный чат создан",
+                         'timestamp': timestamps.iso(created_ms), 'created_ms': created_ms,
+                         'login': 'system', 'image_url': None}, [user1_id, user2_id])
 
         return jsonify({
             'status': 'success',
@@ -531,16 +947,185 @@ def create_private_chat():
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
+def publish_message(message, member_ids=None):
+    if not hub.has_subscribers():
+        return
+    if member_ids is None:
+        with chat_db() as conn:
+            member_ids = store.chat_member_ids(conn, message['chat_id'])
+    hub.publish(member_ids, {'id': message['id'], 'event': 'message', 'data': message})
+
+
+def publish_chat(chat, member_ids, targets=None):
+    hub.publish(member_ids if targets is None else targets,
+                {'event': 'chat', 'data': dict(chat, members=member_ids)})
+
+
+@app.route('/stream', methods=['GET'])
+def stream():
+    try:
+        user_id = int(current_user_id(request.args.get('user_id', '')))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'No user_id provided'}), 400
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    # Subscribe before replaying so nothing published in between is lost;
+    # live events already covered by the replay are skipped below.
+    subscription = hub.subscribe(user_id)
+
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            replayed_id = 0
+            if last_event_id is not None:
+                limit = app.config['STREAM_REPLAY_LIMIT']
+                with chat_db() as conn:
+                    missed = conn.execute('''
+                        SELECT messages.* FROM chat_members
+                        CROSS JOIN messages ON messages.chat_id = chat_members.chat_id AND messages.id > ?
+                        WHERE chat_members.user_id = ?
+                        ORDER BY messages.id LIMIT ?
+                    ''', (last_event_id, user_id, limit + 1)).fetchall()
+                if len(missed) > limit:
+                    # Too far behind to replay; the client should refetch via /get_messages.
+                    yield format_sse({'event': 'reset', 'data': {'last_event_id': last_event_id}})
+                    missed = []
+                for row in missed:
+                    message = timestamps.message_out(dict(row))
+                    replayed_id = message['id']
+                    yield format_sse({'id': message['id'], 'event': 'message', 'data': message})
+
+            while not subscription.dropped:
+                event = subscription.get(HEARTBEAT_INTERVAL)
+                if event is None:
+                    yield ': heartbeat\n\n'
+                    continue
+                if event.get('id') is not None and event['id'] <= replayed_id:
+                    continue
+                yield format_sse(event)
+        finally:
+            hub.unsubscribe(subscription)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/pool_stats', methods=['GET'])
+def get_pool_stats():
+    return jsonify(dict(pool_stats(), writer=message_writer.stats(), tokens=auth.token_cache.stats(),
+                        membership=membership_cache.stats(), recent=recent_messages.stats())), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Component stats are exported as gauges, one family per numeric field.
+    sources = [
+        ('db_pool', {(('db', name),): stats for name, stats in pool_stats().items()}),
+        ('writer', {(): message_writer.stats()}),
+        ('sse', {(): hub.stats()}),
+        ('token_cache', {(): auth.token_cache.stats()}),
+        ('membership_cache', {(): membership_cache.stats()}),
+        ('recent_cache', {(): recent_messages.stats()}),
+    ]
+    gauges = []
+    for prefix, groups in sources:
+        families = {}
+        for labels, stats in groups.items():
+            for key, value in stats.items():
+                if isinstance(value, (int, float)):
+                    families.setdefault(key, {})[labels] = value
+        for key, values in families.items():
+            gauges.append((f'duckchat_{prefix}_{key}', f'{prefix} {key}.', values))
+    return Response(metrics.registry.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+# Registered first so requests rejected by later before_request hooks are counted too.
+@app.before_request
+def start_request_metrics():
+    g.metrics_route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.metrics_started = time.perf_counter()
+    metrics.registry.request_started(g.metrics_route)
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    route = g.pop('metrics_route', None)
+    if route is not None:
+        metrics.registry.request_finished(route, request.method, g.get('status', 500),
+                                          time.perf_counter() - g.metrics_started)
+
+
 @app.before_request
 def log_request_info():
-    logging.info(f"Request: {request.method} {request.path}")
-    if request.method == 'POST' and request.content_type == 'application/json':
-        logging.debug(f"Request data: {request.get_json()}")
+    g.started = time.perf_counter()
+    g.request_id = request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex[:16]
+    rate = app.config['REQUEST_LOG_SAMPLE_RATES'].get(request.endpoint, app.config['REQUEST_LOG_SAMPLE_RATE'])
+    g.log_sampled = rate >= 1 or random.random() < rate
+    if request.method == 'POST' and logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('request id=%s data=%s', g.request_id, request.get_data(as_text=True))
+
+
+# Request fields that name the caller. With a session token they must match it
+# (or be left out); other ids in the request, like the user being added, are not checked.
+CALLER_FIELDS = {
+    'get_messages': 'user_id', 'get_chats': 'user_id', 'get_user_chats': 'user_id',
+    'sync': 'user_id', 'search_messages': 'user_id', 'stream': 'user_id',
+    'mark_messages_as_read': 'user_id', 'create_group_chat': 'creator_id',
+    'add_user_to_chat': 'adder_id', 'create_private_chat': 'user1_id', 'send_message': 'login',
+}
+PUBLIC_ENDPOINTS = {'index', 'login', 'set_date', 'uploaded_file', 'static'}
+
+
+def session_token():
+    header = request.headers.get('Authorization', '')
+    if header.startswith('Bearer '):
+        return header[7:].strip()
+    # EventSource can't set headers, so /stream takes the token as a query parameter.
+    return request.args.get('access_token')
+
+
+def request_field(name):
+    if request.is_json:
+        data = request.get_json(silent=True)
+        value = data.get(name) if isinstance(data, dict) else None
+    else:
+        value = request.form.get(name)
+    return request.args.get(name) if value is None else value
+
+
+@app.before_request
+def load_session():
+    g.user = None
+    token = session_token()
+    if token:
+        g.user = auth.resolve(token)
+        if g.user is None:
+            return jsonify({'status': 'error', 'message': 'Invalid or expired session'}), 401
+    elif app.config['REQUIRE_AUTH'] and request.endpoint not in PUBLIC_ENDPOINTS:
+        return jsonify({'status': 'error', 'message': 'Authentication required'}), 401
+
+    field = CALLER_FIELDS.get(request.endpoint)
+    if g.user and field:
+        claimed = request_field(field)
+        expected = g.user['login'] if field == 'login' else g.user['user_id']
+        if claimed not in (None, '') and str(claimed) != str(expected):
+            return jsonify({'status': 'error', 'message': 'Access denied'}), 403
 
 
 @app.after_request
 def log_response_info(response):
-    logging.info(f"Response: {response.status}")
+    # One line per request. For streamed responses the duration is time to first byte.
+    duration_ms = (time.perf_counter() - g.started) * 1000
+    if g.log_sampled or response.status_code >= 400 or duration_ms >= app.config['SLOW_REQUEST_MS']:
+        logging.info('request id=%s method=%s path=%s status=%d duration_ms=%.1f',
+                     g.request_id, request.method, request.path, response.status_code, duration_ms)
+    response.headers['X-Request-ID'] = g.request_id
+    g.status = response.status_code
     return response
 
 
@@ -555,16 +1140,19 @@ def login():
         password = request.form.get('password')
 
     if login and password:
-        connect = personal_data_db_connection()
-        user = connect.execute('SELECT * FROM personal_date WHERE login = ? AND password = ?',
-                               (login, password)).fetchone()
-        connect.close()
+        try:
+            user = auth.authenticate(login, password)
+        except auth.HashingBusy:
+            return jsonify({'status': 'error', 'message': 'Too many login attempts, try again'}), 503
 
         if user:
+            token, expires_at = auth.issue(user)
             return jsonify({
                 'status': 'success',
                 'message': 'Login successful',
-                'user_id': user['id']
+                'user_id': user['id'],
+                'token': token,
+                'expires_at': int(expires_at)
             }), 200
         else:
             return jsonify({'status': 'error', 'message': 'Invalid login or password'}), 401
@@ -572,5 +1160,14 @@ def login():
         return jsonify({'status': 'error', 'message': 'No login or password provided'}), 400
 
 
+@app.route('/logout', methods=['POST'])
+def logout():
+    token = session_token()
+    if not token:
+        return jsonify({'status': 'error', 'message': 'No session token provided'}), 400
+    auth.revoke(token)
+    return jsonify({'status': 'success', 'message': 'Logged out'}), 200
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
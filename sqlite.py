@@ -1,15 +1,6 @@
-import sqlite3
-
-def init_db():
-    conn = sqlite3.connect('chat.db')
-    con = conn.cursor()
-    con.execute('''CREATE TABLE IF NOT EXISTS messages
-                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                     chat_id TEXT NOT NULL,
-                     message TEXT NOT NULL,
-                     timestamp TEXT NOT NULL)''')
-    conn.commit()
-    conn.close()
+# The chat.db schema lives in chat.py and is evolved by migrations.py; this module
+# used to create a conflicting messages table and is kept only as an entry point.
+from chat import init_db
 
 if __name__ == '__main__':
-    init_db()
\ No newline at end of file
+    init_db()
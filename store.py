@@ -0,0 +1,85 @@
+import timestamps
+
+# Queries shared by the Flask app (server.py) and the WebSocket gateway (gateway.py).
+# Each helper runs on a connection handed out by database.chat_db()/login_db().
+
+
+def parse_id(value):
+    # Ids arrive as JSON numbers or form/query strings; anything else is None.
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    return None
+
+
+def insert_message(conn, chat_id, message, login, image_url=None, created_ms=None):
+    if created_ms is None:
+        created_ms = timestamps.now_ms()
+    cursor = conn.execute('''
+        INSERT INTO messages (chat_id, message, timestamp, created_ms, login, image_url)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (chat_id, message or '', timestamps.legacy_text(created_ms), created_ms, login, image_url))
+    return {'id': cursor.lastrowid, 'chat_id': chat_id, 'message': message, 'timestamp': timestamps.iso(created_ms),
+            'created_ms': created_ms, 'login': login, 'image_url': image_url}
+
+
+def insert_messages(conn, rows):
+    # rows are (chat_id, message, login, image_url). AUTOINCREMENT ids are handed
+    # out consecutively inside one write transaction, so the ids of the batch are
+    # the last len(rows) values of the messages sequence.
+    created_ms = timestamps.now_ms()
+    timestamp = timestamps.legacy_text(created_ms)
+    conn.executemany('''
+        INSERT INTO messages (chat_id, message, timestamp, created_ms, login, image_url)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', [(chat_id, message or '', timestamp, created_ms, login, image_url)
+          for chat_id, message, login, image_url in rows])
+    last_id = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()[0]
+    first_id = last_id - len(rows) + 1
+    return [{'id': first_id + i, 'chat_id': chat_id, 'message': message, 'timestamp': timestamps.iso(created_ms),
+             'created_ms': created_ms, 'login': login, 'image_url': image_url}
+            for i, (chat_id, message, login, image_url) in enumerate(rows)]
+
+
+def chat_member_ids(conn, chat_id):
+    return [row['user_id'] for row in conn.execute(
+        'SELECT user_id FROM chat_members WHERE chat_id = ?', (chat_id,))]
+
+
+def direct_chat_id(conn, user_a, user_b):
+    # Private chats are keyed by the ordered pair, so (a, b) and (b, a) are the same probe.
+    low, high = sorted((int(user_a), int(user_b)))
+    row = conn.execute('SELECT chat_id FROM direct_chats WHERE user_low = ? AND user_high = ?',
+                       (low, high)).fetchone()
+    return row['chat_id'] if row else None
+
+
+def add_direct_chat(conn, user_a, user_b, chat_id):
+    low, high = sorted((int(user_a), int(user_b)))
+    cursor = conn.execute('''
+        INSERT INTO direct_chats (user_low, user_high, chat_id) VALUES (?, ?, ?)
+        ON CONFLICT (user_low, user_high) DO NOTHING
+    ''', (low, high, chat_id))
+    return cursor.rowcount > 0
+
+
+def mark_read(conn, chat_id, user_id, message_id=None):
+    # Moves only the caller's cursor forward; defaults to the newest message and
+    # never goes past it, so later messages still count as unread. A cursor that
+    # isn't an integer (stored before ids were validated) counts as 0.
+    cursor = conn.execute('''
+        UPDATE chat_members
+        SET last_read_message_id = MAX(
+            CASE WHEN typeof(last_read_message_id) = 'integer' THEN last_read_message_id ELSE 0 END,
+            COALESCE(MIN(?, (SELECT MAX(id) FROM messages WHERE chat_id = ?)),
+                     (SELECT MAX(id) FROM messages WHERE chat_id = ?), 0))
+        WHERE chat_id = ? AND user_id = ?
+    ''', (message_id, chat_id, chat_id, chat_id, user_id))
+    return cursor.rowcount > 0
+
+
+def user_by_login(conn, login):
+    return conn.execute('SELECT * FROM personal_date WHERE login = ?', (login,)).fetchone()
@@ -0,0 +1,160 @@
+import base64
+import io
+import json
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+import uploads
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+THUMBNAIL_SIZES = (128, 512)
+PLACEHOLDER_SIZE = 16
+WORKERS = 2
+RENDER_TIMEOUT = 10.0
+
+MIGRATION = [
+    'ALTER TABLE uploads ADD COLUMN thumbnails TEXT',
+    'ALTER TABLE uploads ADD COLUMN placeholder TEXT',
+]
+
+_executor = None
+# (filename, size) pairs whose source isn't a decodable image; not retried.
+_undecodable = set()
+
+
+class RenderFailed(Exception):
+    pass
+
+
+def enabled():
+    return Image is not None
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=WORKERS)
+    return _executor
+
+
+def is_variant(filename):
+    stem = os.path.splitext(filename)[0]
+    size = stem.rsplit('_', 1)[-1] if '_' in stem else ''
+    return size.isdigit() and int(size) in THUMBNAIL_SIZES
+
+
+def variant_name(filename, size):
+    stem, ext = os.path.splitext(filename)
+    # GIF thumbnails are the first frame as PNG.
+    return f'{stem}_{size}{".jpg" if ext.lower() in (".jpg", ".jpeg") else ".png"}'
+
+
+def _prepare(image, jpeg):
+    if jpeg:
+        return image.convert('RGB')
+    return image.convert('RGBA') if image.mode in ('P', 'LA', 'RGBA') else image.convert('RGB')
+
+
+def render_variant(source_path, target_path, size):
+    # Runs in a worker process. Writes through a temp file so readers never see
+    # a partial thumbnail.
+    with Image.open(source_path) as image:
+        image.thumbnail((size, size))
+        jpeg = target_path.endswith('.jpg')
+        image = _prepare(image, jpeg)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(target_path), prefix='.thumb-')
+        with os.fdopen(fd, 'wb') as out:
+            image.save(out, 'JPEG' if jpeg else 'PNG', quality=80, optimize=True)
+        os.chmod(temp_path, uploads.FILE_MODE)
+        os.replace(temp_path, target_path)
+    return target_path
+
+
+def render_placeholder(source_path):
+    # A tiny blurred preview as a data URI, small enough to inline in message lists.
+    with Image.open(source_path) as image:
+        image.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+        out = io.BytesIO()
+        image.convert('RGB').save(out, 'JPEG', quality=40)
+    return 'data:image/jpeg;base64,' + base64.b64encode(out.getvalue()).decode('ascii')
+
+
+def render_all(source_path, folder, filename, sizes=THUMBNAIL_SIZES):
+    variants = {}
+    for size in sizes:
+        name = variant_name(filename, size)
+        render_variant(source_path, uploads.target_path(folder, name), size)
+        variants[str(size)] = name
+    return variants, render_placeholder(source_path)
+
+
+def schedule(folder, filename, on_done):
+    if not enabled():
+        return None
+    future = executor().submit(render_all, uploads.locate(folder, filename), folder, filename)
+
+    def done(finished):
+        try:
+            variants, placeholder = finished.result()
+        except Exception as e:
+            logging.error(f"Thumbnail generation for {filename} failed: {e}")
+            return
+        on_done(filename, variants, placeholder)
+
+    future.add_done_callback(done)
+    return future
+
+
+def render_on_demand(folder, filename, size):
+    # Raises RenderFailed if the source can't be decoded (legacy uploads were
+    # only checked by extension) or the render outlives RENDER_TIMEOUT; a
+    # render that timed out still finishes in the background.
+    name = variant_name(filename, size)
+    path = uploads.locate(folder, name)
+    if path is None:
+        if (filename, size) in _undecodable:
+            raise RenderFailed(f'{filename} is not a decodable image')
+        path = uploads.target_path(folder, name)
+        try:
+            executor().submit(render_variant, uploads.locate(folder, filename), path, size).result(RENDER_TIMEOUT)
+        except FutureTimeout:
+            raise RenderFailed(f'Rendering {name} took longer than {RENDER_TIMEOUT}s')
+        except Exception as e:
+            _undecodable.add((filename, size))
+            raise RenderFailed(f'Cannot render {name}: {e}')
+    return path
+
+
+def save_variants(conn, content_hash, variants, placeholder):
+    conn.execute('UPDATE uploads SET thumbnails = ?, placeholder = ? WHERE hash = ?',
+                 (json.dumps(variants), placeholder, content_hash))
+
+
+def attach(conn, messages, url_for_variant):
+    # Adds 'thumbnails' ({size: url}) and 'placeholder' to messages whose image
+    # is a content-addressed upload that has finished processing.
+    hashes = {}
+    for message in messages:
+        filename = (message.get('image_url') or '').rsplit('/', 1)[-1]
+        stem = filename.split('.', 1)[0]
+        if len(stem) == 64:
+            hashes.setdefault(stem, []).append((message, filename))
+    if not hashes:
+        return messages
+    placeholders = ', '.join('?' * len(hashes))
+    rows = conn.execute(f'''
+        SELECT hash, thumbnails, placeholder FROM uploads
+        WHERE hash IN ({placeholders}) AND thumbnails IS NOT NULL
+    ''', list(hashes)).fetchall()
+    for row in rows:
+        sizes = json.loads(row['thumbnails'])
+        for message, filename in hashes[row['hash']]:
+            message['thumbnails'] = {size: url_for_variant(filename, int(size)) for size in sizes}
+            message['placeholder'] = row['placeholder']
+    return messages
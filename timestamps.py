@@ -0,0 +1,176 @@
+import sqlite3
+import sys
+import threading
+import time
+import logging
+from datetime import datetime, timezone
+
+from database import CHAT_DB
+
+LEGACY_FORMAT = '%d/%m/%Y %H:%M:%S'
+BACKFILL_CHUNK = 1000
+BACKFILL_PAUSE = 0.05
+
+# Times are stored as integer milliseconds since the epoch (UTC) in created_ms
+# columns and rendered as ISO-8601 by the API. The old text columns
+# (messages.timestamp, chats.created_at) are still written, in their local-time
+# dd/mm/YYYY format, for anything that reads the database directly.
+#
+# Rows from before migration 11 (id <= watermark) are converted by backfill()
+# in small transactions, tracked in timestamp_backfill; until then their
+# created_ms is NULL and the API falls back to parsing the text column.
+
+# The text column read as local time, like datetime.now() wrote it.
+LEGACY_MS = '''CAST(strftime('%s', substr({column}, 7, 4) || '-' || substr({column}, 4, 2) || '-' ||
+                                  substr({column}, 1, 2) || substr({column}, 11), 'utc') AS INTEGER) * 1000'''
+
+MIGRATION = [
+    'ALTER TABLE messages ADD COLUMN created_ms INTEGER',
+    'ALTER TABLE chats ADD COLUMN created_ms INTEGER',
+    'ALTER TABLE chats ADD COLUMN last_message_ms INTEGER',
+    'CREATE INDEX IF NOT EXISTS idx_messages_chat_created ON messages (chat_id, created_ms)',
+    '''CREATE TABLE IF NOT EXISTS timestamp_backfill (
+           name TEXT PRIMARY KEY,
+           watermark INTEGER NOT NULL,
+           position INTEGER NOT NULL
+       )''',
+    '''INSERT OR IGNORE INTO timestamp_backfill (name, watermark, position)
+       SELECT 'messages', COALESCE((SELECT MAX(id) FROM messages), 0), 0''',
+    '''INSERT OR IGNORE INTO timestamp_backfill (name, watermark, position)
+       SELECT 'chats', COALESCE((SELECT MAX(id) FROM chats), 0), 0''',
+    # Migration 10's chat summary trigger, now also carrying the message time.
+    'DROP TRIGGER IF EXISTS chat_summary_on_message',
+    '''CREATE TRIGGER chat_summary_on_message AFTER INSERT ON messages BEGIN
+           UPDATE chats SET
+               message_count = message_count + 1,
+               last_message_at = CASE WHEN NEW.id > last_message_id THEN NEW.timestamp ELSE last_message_at END,
+               last_message_ms = CASE WHEN NEW.id > last_message_id THEN NEW.created_ms ELSE last_message_ms END,
+               last_message_preview = CASE WHEN NEW.id > last_message_id
+                                           THEN substr(NEW.message, 1, 100) ELSE last_message_preview END,
+               last_sender = CASE WHEN NEW.id > last_message_id THEN NEW.login ELSE last_sender END,
+               last_message_id = MAX(last_message_id, NEW.id)
+           WHERE id = NEW.chat_id;
+       END''',
+]
+
+# Chats come second: their last_message_ms is copied from converted messages.
+BACKFILL_STEPS = [
+    ('messages', f'''
+        UPDATE messages SET created_ms = COALESCE({LEGACY_MS.format(column='timestamp')}, 0)
+        WHERE id > ? AND id <= ? AND created_ms IS NULL
+    '''),
+    ('chats', f'''
+        UPDATE chats SET
+            created_ms = COALESCE(created_ms, {LEGACY_MS.format(column='created_at')}, 0),
+            last_message_ms = COALESCE(last_message_ms,
+                                       (SELECT created_ms FROM messages WHERE messages.id = chats.last_message_id))
+        WHERE id > ? AND id <= ?
+    '''),
+]
+
+
+def now_ms():
+    return time.time_ns() // 1000000
+
+
+def legacy_text(ms):
+    return datetime.fromtimestamp(ms / 1000).strftime(LEGACY_FORMAT)
+
+
+def parse_legacy(text):
+    try:
+        return int(datetime.strptime(text, LEGACY_FORMAT).timestamp() * 1000)
+    except (TypeError, ValueError):
+        return None
+
+
+def iso(ms):
+    if ms is None:
+        return None
+    return datetime.fromtimestamp(ms / 1000, timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+def parse_time(value):
+    # Query parameters: epoch milliseconds or ISO-8601; a time without an offset is UTC.
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def message_out(message):
+    # Takes a messages row as a dict and rewrites its time fields for the API.
+    ms = message.get('created_ms')
+    if ms is None:
+        ms = parse_legacy(message.get('timestamp'))
+    message['created_ms'] = ms
+    message['timestamp'] = iso(ms)
+    return message
+
+
+def chat_out(chat):
+    if 'created_at' in chat:
+        ms = chat.get('created_ms')
+        chat['created_ms'] = ms if ms is not None else parse_legacy(chat['created_at'])
+        chat['created_at'] = iso(chat['created_ms'])
+    if 'last_message_at' in chat:
+        ms = chat.get('last_message_ms')
+        chat['last_message_ms'] = ms if ms is not None else parse_legacy(chat['last_message_at'])
+        chat['last_message_at'] = iso(chat['last_message_ms'])
+    return chat
+
+
+def backfill(path=CHAT_DB, chunk=BACKFILL_CHUNK, pause=BACKFILL_PAUSE):
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+    try:
+        for name, sql in BACKFILL_STEPS:
+            while True:
+                # Each chunk is its own short IMMEDIATE transaction so writers only
+                # ever wait for one chunk. Progress is read under the lock, so
+                # several processes can run this at once.
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    row = conn.execute('SELECT watermark, position FROM timestamp_backfill WHERE name = ?',
+                                       (name,)).fetchone()
+                    if row is None or row[1] >= row[0]:
+                        conn.execute('COMMIT')
+                        break
+                    watermark, position = row
+                    end = min(position + chunk, watermark)
+                    conn.execute(sql, (position, end))
+                    conn.execute('UPDATE timestamp_backfill SET position = ? WHERE name = ?', (end, name))
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+                logging.debug(f"Timestamp backfill of {name} at {end}/{watermark}")
+                time.sleep(pause)
+    finally:
+        conn.close()
+
+
+def start_backfill(path=CHAT_DB):
+    def run():
+        try:
+            backfill(path)
+        except Exception:
+            logging.error('Timestamp backfill failed; it resumes on the next start', exc_info=True)
+
+    thread = threading.Thread(target=run, name='timestamp-backfill', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='[%(asctime)s | %(levelname)s: %(message)s]',
+                        datefmt='%Y.%m.%d %H:%M:%S', level=logging.DEBUG)
+    if sys.argv[1:2] == ['backfill']:
+        from migrations import run_migrations
+        run_migrations()
+        backfill()
+    else:
+        print('usage: python timestamps.py backfill')
@@ -0,0 +1,145 @@
+import hashlib
+import os
+import string
+import sys
+import tempfile
+from datetime import datetime
+
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# mkstemp() creates files as 0600; stored files get the mode a plain open()
+# would have given them, so a front proxy running as another user can read them.
+# The umask can only be read by setting it, so that happens once, at import.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
+
+# Magic bytes of the image types we accept, mapped to the extension we store.
+SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+]
+
+MIGRATION = [
+    '''CREATE TABLE IF NOT EXISTS uploads (
+           hash TEXT PRIMARY KEY,
+           ext TEXT NOT NULL,
+           size INTEGER NOT NULL,
+           ref_count INTEGER NOT NULL DEFAULT 1,
+           created_at TEXT NOT NULL
+       ) WITHOUT ROWID''',
+]
+
+
+def content_hash(filename):
+    # '<sha256>.<ext>' and its thumbnails '<sha256>_<size>.<ext>' are named after
+    # their content; legacy uuid-named uploads are not.
+    stem = filename.split('.', 1)[0].split('_', 1)[0]
+    if len(stem) == 64 and all(c in string.hexdigits for c in stem):
+        return stem
+    return None
+
+
+def target_path(folder, filename):
+    # Content-addressed files live in two levels of hash-prefix directories so no
+    # single directory grows to millions of entries.
+    digest = content_hash(filename)
+    if digest is None:
+        return os.path.join(folder, filename)
+    return os.path.join(folder, digest[:2], digest[2:4], filename)
+
+
+def locate(folder, filename):
+    for path in (target_path(folder, filename), os.path.join(folder, filename)):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class UnsupportedType(Exception):
+    pass
+
+
+def sniff_type(header):
+    for signature, ext in SIGNATURES:
+        if header.startswith(signature):
+            return ext
+    return None
+
+
+def save_upload(conn, stream, folder, max_size=MAX_UPLOAD_SIZE):
+    # Streams the upload into a temp file next to its final location while
+    # hashing it, then stores it under <sha256>.<ext>. A file we already have is
+    # not written again; its reference count goes up instead.
+    digest = hashlib.sha256()
+    size = 0
+    ext = None
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if ext is None:
+                    ext = sniff_type(chunk)
+                    if ext is None:
+                        raise UnsupportedType('File type not allowed')
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLarge(f'File is larger than {max_size} bytes')
+                digest.update(chunk)
+                out.write(chunk)
+        if ext is None:
+            raise UnsupportedType('Empty file')
+
+        content_hash = digest.hexdigest()
+        filename = f'{content_hash}.{ext}'
+        duplicate = locate(folder, filename) is not None
+        if duplicate:
+            os.unlink(temp_path)
+        else:
+            final_path = target_path(folder, filename)
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.chmod(temp_path, FILE_MODE)
+            os.replace(temp_path, final_path)
+
+        conn.execute('''
+            INSERT INTO uploads (hash, ext, size, ref_count, created_at) VALUES (?, ?, ?, 1, ?)
+            ON CONFLICT (hash) DO UPDATE SET ref_count = ref_count + 1
+        ''', (content_hash, ext, size, datetime.now().strftime("%d/%m/%Y %H:%M:%S")))
+        return filename, duplicate
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def shard_existing(folder):
+    # Moves content-addressed files stored flat in the upload folder into their
+    # hash-prefix directories.
+    moved = 0
+    for filename in os.listdir(folder):
+        path = os.path.join(folder, filename)
+        if content_hash(filename) is None or not os.path.isfile(path):
+            continue
+        final_path = target_path(folder, filename)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(path, final_path)
+        moved += 1
+    return moved
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['shard']:
+        from configForServer import UPLOAD_FOLDER
+        print(f'Moved {shard_existing(sys.argv[2] if len(sys.argv) > 2 else UPLOAD_FOLDER)} files')
+    else:
+        print('usage: python uploads.py shard [folder]')
@@ -0,0 +1,123 @@
+import os
+import secrets
+import sqlite3
+import threading
+import time
+import logging
+import zlib
+
+from database import CHAT_DB, chat_db
+
+# Upper bound on how stale stamps can get when a commit leaves the WAL file's
+# size and mtime unchanged.
+FEED_POLL_INTERVAL = 1.0
+
+
+class VersionStamps:
+    # Per-chat and per-user stamps for ETags that can be checked without
+    # running the page query. A chat's stamp is the last change-feed seq that
+    # touched it (a message); a user's, the last one about their membership or
+    # read cursor.
+    #
+    # The feed is written by triggers in the same transaction as the change, so
+    # every writer shows up in it: this process, the gateway, other workers,
+    # ad-hoc scripts. refresh() reads what was appended since the last call,
+    # and only when chat.db's WAL file has changed or FEED_POLL_INTERVAL has
+    # passed. Thumbnails, the one page input outside the feed, have their own
+    # small feed (upload_changes) and invalidate every ETag.
+    def __init__(self, wal_path=CHAT_DB + '-wal', interval=FEED_POLL_INTERVAL):
+        self.wal_path = wal_path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._prefix = secrets.token_hex(4)
+        self._epoch = 0
+        self._chats = {}
+        self._users = {}
+        self._seq = None
+        self._upload_seq = None
+        self._wal_seen = None
+        self._polled = 0.0
+        self._listeners = []
+
+    def subscribe(self, listener):
+        # listener(messages, uploads): (chat_id, message_id) pairs and content
+        # hashes that changed, called from refresh() before it returns.
+        self._listeners.append(listener)
+
+    def _wal_state(self):
+        try:
+            stat = os.stat(self.wal_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def refresh(self, force=False):
+        # Writers call this after committing (force=True); readers on every
+        # ETag check, where it is a stat() unless something was written.
+        with self._refresh_lock:
+            state = self._wal_state()
+            now = time.monotonic()
+            if not force and state == self._wal_seen and now - self._polled < self.interval:
+                return
+            # Recorded before reading, so a commit that lands during the read
+            # changes the WAL again and is picked up by the next call.
+            self._wal_seen = state
+            self._polled = now
+            try:
+                with chat_db() as conn:
+                    if self._seq is None:
+                        self._seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+                        self._upload_seq = conn.execute(
+                            'SELECT COALESCE(MAX(seq), 0) FROM upload_changes').fetchone()[0]
+                        return
+                    changes = conn.execute('SELECT seq, chat_id, user_id, kind, ref_id FROM changes WHERE seq > ?',
+                                           (self._seq,)).fetchall()
+                    uploads = conn.execute('SELECT seq, hash FROM upload_changes WHERE seq > ?',
+                                           (self._upload_seq,)).fetchall()
+            except sqlite3.Error as e:
+                # Can't tell what changed, so nothing cached is trusted.
+                logging.warning(f"Reading the change feed failed: {e}")
+                with self._lock:
+                    self._epoch += 1
+                for listener in self._listeners:
+                    listener(None, None)
+                return
+
+            messages = []
+            with self._lock:
+                for seq, chat_id, user_id, kind, ref_id in changes:
+                    if kind == 'message':
+                        self._chats[chat_id] = seq
+                        messages.append((chat_id, ref_id))
+                    elif user_id is not None:
+                        self._users[user_id] = seq
+                    self._seq = seq
+                if uploads:
+                    self._epoch += 1
+                    self._upload_seq = uploads[-1][0]
+            if messages or uploads:
+                for listener in self._listeners:
+                    listener(messages, [upload_hash for _, upload_hash in uploads])
+
+    def chat_etag(self, chat_id, *query):
+        # A message page: the chat's stamp plus whatever selects the page.
+        self.refresh()
+        with self._lock:
+            stamp = self._chats.get(int(chat_id), 0)
+            return f'{self._prefix}.{self._epoch}.c{int(chat_id)}.{stamp}.{_digest(query)}'
+
+    def chats_etag(self, user_id, chat_ids, *query):
+        # A user's chat list: their own stamp (read cursors) and those of every chat they're in.
+        self.refresh()
+        with self._lock:
+            stamps = sorted((chat_id, self._chats.get(chat_id, 0)) for chat_id in chat_ids)
+            stamp = self._users.get(int(user_id), 0)
+            return f'{self._prefix}.{self._epoch}.u{int(user_id)}.{stamp}.{_digest((stamps, query))}'
+
+
+def _digest(value):
+    return f'{zlib.crc32(repr(value).encode("utf-8")):08x}'
+
+
+version_stamps = VersionStamps()
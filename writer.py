@@ -0,0 +1,141 @@
+import queue
+import sqlite3
+import threading
+import time
+import logging
+from concurrent.futures import Future
+
+import store
+from database import chat_db
+from recent import recent_messages
+from versions import version_stamps
+
+GROUP_COMMIT = True
+BATCH_SIZE = 256
+BATCH_WAIT = 0.005
+WRITE_TIMEOUT = 10.0
+
+
+class MessageWriter:
+    # One thread owns message inserts and commits them in batches: up to
+    # batch_size rows, or whatever arrived within batch_wait of the first one.
+    def __init__(self, batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._rows = 0
+        self._failed = 0
+        self._max_batch = 0
+        self._last_batch = 0
+        self._commit_time = 0.0
+        self._last_commit = 0.0
+        self._max_commit = 0.0
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+                    self._thread.start()
+
+    def submit(self, chat_id, message, login, image_url=None, created_ms=None):
+        self._ensure_started()
+        future = Future()
+        self._queue.put((future, (chat_id, message, login, image_url, created_ms)))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.batch_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.perf_counter()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0
+                                 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._commit(batch)
+            except Exception as e:
+                # Never let the writer thread die: later sends would all time out.
+                logging.error(f"Message writer failed on a batch of {len(batch)}: {e}", exc_info=True)
+                for future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _commit(self, batch):
+        started = time.perf_counter()
+        results = []
+        try:
+            with recent_messages.write_lock:
+                with chat_db() as conn:
+                    for future, args in batch:
+                        # A failing row only aborts its own statement, not the batch.
+                        try:
+                            results.append((future, store.insert_message(conn, *args), None))
+                        except sqlite3.Error as e:
+                            results.append((future, None, e))
+                recent_messages.add([stored for _, stored, error in results if error is None])
+        except Exception as e:
+            logging.error(f"Group commit of {len(batch)} messages failed: {e}", exc_info=True)
+            for future, _ in batch:
+                future.set_exception(e)
+            with self._lock:
+                self._failed += len(batch)
+            return
+
+        elapsed = time.perf_counter() - started
+        # The rows are committed; whatever happens here, every caller gets its result.
+        try:
+            version_stamps.refresh(force=True)
+            with self._lock:
+                self._batches += 1
+                self._rows += len(batch)
+                self._last_batch = len(batch)
+                self._max_batch = max(self._max_batch, len(batch))
+                self._commit_time += elapsed
+                self._last_commit = elapsed
+                self._max_commit = max(self._max_commit, elapsed)
+                self._failed += sum(1 for _, _, error in results if error is not None)
+        except Exception as e:
+            logging.error(f"Bookkeeping after group commit of {len(batch)} messages failed: {e}", exc_info=True)
+        for future, stored, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(stored)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': GROUP_COMMIT,
+                'queue_depth': self._queue.qsize(),
+                'batches': self._batches,
+                'rows': self._rows,
+                'failed': self._failed,
+                'avg_batch_size': self._rows / self._batches if self._batches else 0.0,
+                'last_batch_size': self._last_batch,
+                'max_batch_size': self._max_batch,
+                'avg_commit_ms': self._commit_time / self._batches * 1000 if self._batches else 0.0,
+                'last_commit_ms': self._last_commit * 1000,
+                'max_commit_ms': self._max_commit * 1000,
+            }
+
+
+message_writer = MessageWriter()
+
+
+def write_message(chat_id, message, login, image_url=None, created_ms=None):
+    if GROUP_COMMIT:
+        return message_writer.submit(chat_id, message, login, image_url, created_ms).result(WRITE_TIMEOUT)
+    with recent_messages.write_lock:
+        with chat_db() as conn:
+            stored = store.insert_message(conn, chat_id, message, login, image_url, created_ms)
+        recent_messages.add([stored])
+    version_stamps.refresh(force=True)
+    return stored
@@ -0,0 +1,129 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import websockets
+
+# Connection-count and per-message latency benchmark for gateway.py.
+# Runs the gateway in-process against throwaway databases in a temp directory:
+#   python ws_bench.py --connections 10000 --messages 500
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def seed(users, members):
+    # Returns one session token per user, so connecting skips password hashing.
+    import auth
+    from migrations import run_migrations
+    run_migrations()
+    login_conn = sqlite3.connect('login.db')
+    login_conn.executemany('INSERT INTO personal_date (login, password) VALUES (?, ?)',
+                           [(f'bench{i}', 'secret') for i in range(users)])
+    login_conn.commit()
+    login_conn.close()
+    tokens = [auth.issue({'id': i + 1, 'login': f'bench{i}'})[0] for i in range(users)]
+    chat_conn = sqlite3.connect('chat.db')
+    chat_id = chat_conn.execute(
+        "INSERT INTO chats (name, is_private, creator_id, created_at) VALUES ('bench', 0, 1, '')").lastrowid
+    chat_conn.executemany('INSERT INTO chat_members (chat_id, user_id) VALUES (?, ?)',
+                          [(chat_id, i + 1) for i in range(members)])
+    chat_conn.commit()
+    chat_conn.close()
+    return tokens
+
+
+async def open_client(url, index, token):
+    websocket = await websockets.connect(url, compression=None, max_size=2 ** 16,
+                                         ping_interval=None, open_timeout=60, close_timeout=1)
+    await websocket.send(json.dumps({'type': 'auth', 'token': token}))
+    reply = json.loads(await websocket.recv())
+    if reply.get('type') != 'auth_ok':
+        raise RuntimeError(f'auth failed for bench{index}: {reply}')
+    return websocket
+
+
+async def run(tokens, messages, port):
+    import gateway
+
+    ready = asyncio.get_running_loop().create_future()
+    server = asyncio.ensure_future(gateway.serve('127.0.0.1', port, ready))
+    gw = await ready
+    url = f'ws://127.0.0.1:{port}'
+
+    # Socket i logs in as bench{i}; only the first `members` users belong to the
+    # benchmark chat, the rest are idle connections.
+    started = time.perf_counter()
+    clients = []
+    connections = len(tokens)
+    for batch_start in range(0, connections, 500):
+        batch = range(batch_start, min(batch_start + 500, connections))
+        clients.extend(await asyncio.gather(*(open_client(url, i, tokens[i]) for i in batch)))
+    connect_time = time.perf_counter() - started
+
+    sender, receiver = clients[0], clients[1]
+    sent_at = {}
+    ack_latency = []
+    delivery_latency = []
+    done = asyncio.Event()
+
+    async def receive():
+        async for raw in receiver:
+            frame = json.loads(raw)
+            if frame.get('type') == 'message' and frame['message']['message'] in sent_at:
+                delivery_latency.append(time.perf_counter() - sent_at[frame['message']['message']])
+                if len(delivery_latency) == messages:
+                    done.set()
+                    return
+
+    receiving = asyncio.ensure_future(receive())
+    for i in range(messages):
+        text = f'bench message {i}'
+        sent_at[text] = time.perf_counter()
+        await sender.send(json.dumps({'type': 'send', 'ref': i, 'chat_id': 1, 'message': text}))
+        while True:
+            frame = json.loads(await sender.recv())
+            if frame.get('type') == 'ack':
+                ack_latency.append(time.perf_counter() - sent_at[text])
+                break
+    await asyncio.wait_for(done.wait(), 60)
+    receiving.cancel()
+
+    result = {
+        'connections': gw.stats['peak_connections'],
+        'connect_seconds': round(connect_time, 3),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'messages': messages,
+        'ack_ms': {p: round(percentile(ack_latency, p) * 1000, 2) for p in (50, 95, 99)},
+        'delivery_ms': {p: round(percentile(delivery_latency, p) * 1000, 2) for p in (50, 95, 99)},
+        'ack_mean_ms': round(statistics.mean(ack_latency) * 1000, 2),
+    }
+    await asyncio.gather(*(websocket.close() for websocket in clients))
+    server.cancel()
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='WebSocket gateway benchmark')
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--members', type=int, default=50, help='sockets that belong to the benchmark chat')
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    from gateway import raise_fd_limit
+    raise_fd_limit()
+    os.chdir(tempfile.mkdtemp(prefix='ws_bench_'))
+    connections = max(args.connections, 2)
+    tokens = seed(connections, min(max(args.members, 2), connections))
+    print(json.dumps(asyncio.run(run(tokens, args.messages, args.port)), indent=2))